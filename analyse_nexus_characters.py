@@ -13,6 +13,8 @@ However, the numbers don't quite tally with MrBayes' complaint...
 import sys
 from collections import defaultdict
 
+from nexus_reader import read_nexus
+
 
 class Character(object):
     def __init__(self):
@@ -33,25 +35,11 @@ class Character(object):
 
 
 def analyse(input_file):
-    ntax = 0
+    nex = read_nexus(input_file)
+    ntax = nex.ntax
     matrix = defaultdict(Character)
-
-    with open(input_file) as nexus:
-        in_matrix = False
-        for line in nexus:
-            # Look for the matrix
-            if in_matrix is False:
-                if line.strip() == "MATRIX":
-                    in_matrix = True
-                continue
-
-            # We're in the matrix
-            if line.strip() == ';':
-                break
-            taxon, states = line.split()
-            ntax += 1
-            for i, s in enumerate(states):
-                matrix[i].readings.append(s)
+    for i in range(nex.nchar):
+        matrix[i].readings = [chr(x) for x in nex.matrix[:, i]]
 
     inf = 0
     notinf = 0
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark for nexus_reader, on synthetic NEXUS matrices written to a
+temporary directory (so make sure it has room - the default matrix is
+around 300MB). Compares it with the whole-file regex the combine script
+used to use, and reads an interleaved copy of the same matrix too.
+"""
+
+import os
+import random
+import re
+import shutil
+import tempfile
+import time
+
+from nexus_reader import read_nexus
+
+re_nexus = re.compile(r"""#nexus
+BEGIN Taxa;
+DIMENSIONS ntax=([0-9]+);
+TAXLABELS
+(.*?)
+;
+END;
+BEGIN Characters;
+DIMENSIONS nchar=([0-9]+);
+
+FORMAT
+    datatype=STANDARD
+    missing=-
+    gap=\?
+    symbols="(.*?)"
+;
+MATRIX
+(.*?);
+END;""", re.DOTALL)
+
+
+def write_matrix(filename, ntax, nchar, interleave=0, seed=1):
+    """
+    Write a random matrix in the layout nexus_from_munster uses, or
+    interleaved in blocks of interleave characters.
+    """
+    rand = random.Random(seed)
+    taxa = ["T{}".format(i) for i in range(ntax)]
+    # Make a few rows and reuse them, as random.choice is slow for big files
+    pool = [''.join(rand.choice('aaaabbc-?') for _ in range(nchar)) for _ in range(8)]
+    rows = [pool[i % len(pool)] for i in range(ntax)]
+
+    with open(filename, 'w') as fh:
+        fh.write("""#nexus
+BEGIN Taxa;
+DIMENSIONS ntax={};
+TAXLABELS
+{}
+;
+END;
+BEGIN Characters;
+DIMENSIONS nchar={};
+
+FORMAT
+    datatype=STANDARD
+    missing=-
+    gap=?
+    symbols="a b c"{}
+;
+MATRIX
+""".format(ntax, '\n'.join(taxa), nchar, "\n    interleave" if interleave else ""))
+        if interleave:
+            for start in range(0, nchar, interleave):
+                for taxon, row in zip(taxa, rows):
+                    fh.write("{} {}\n".format(taxon, row[start:start + interleave]))
+                fh.write("\n")
+        else:
+            for taxon, row in zip(taxa, rows):
+                fh.write("{} {}\n".format(taxon, row))
+        fh.write(""";
+END;
+""")
+
+
+def old_read(filename):
+    """
+    The regex based reading of the original combine_nexus_files.Nexus.load
+    """
+    with open(filename) as f:
+        data = f.read()
+    match = re_nexus.match(data)
+    assert match
+    lines = {}
+    for stripe in match.group(5).splitlines():
+        taxon, chars = stripe.split(' ', 1)
+        lines[taxon] = chars
+    return lines
+
+
+def timed(name, size, func, *args):
+    start = time.time()
+    ret = func(*args)
+    secs = time.time() - start
+    print("  {:<28} {:.2f}s ({:.0f} MB/s)".format(name, secs, size / secs / 1e6))
+    return ret
+
+
+def bench(ntax, nchar, interleave):
+    tmp = tempfile.mkdtemp()
+    try:
+        plain = os.path.join(tmp, 'plain.nex')
+        interleaved = os.path.join(tmp, 'interleaved.nex')
+        write_matrix(plain, ntax, nchar)
+        write_matrix(interleaved, ntax, nchar, interleave)
+        size = os.path.getsize(plain)
+        print("{} taxa x {} characters ({:.0f} MB)".format(ntax, nchar, size / 1e6))
+
+        old = timed("regex", size, old_read, plain)
+        new = timed("nexus_reader", size, read_nexus, plain)
+        new_il = timed("nexus_reader (interleaved)", os.path.getsize(interleaved), read_nexus, interleaved)
+
+        for taxon in list(old)[:10]:
+            assert new.row(taxon) == old[taxon] == new_il.row(taxon)
+        assert (new.matrix == new_il.matrix).all()
+        print("  matrix: {:.0f} MB".format(new.matrix.nbytes / 1e6))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark nexus_reader on synthetic matrices")
+    parser.add_argument('-t', '--taxa', default=1500, type=int, help='Number of taxa')
+    parser.add_argument('-c', '--chars', default=200000, type=int, help='Number of characters')
+    parser.add_argument('-i', '--interleave', default=10000, type=int,
+                        help='Characters per block in the interleaved copy')
+    args = parser.parse_args()
+    bench(args.taxa, args.chars, args.interleave)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark for the write phase of nexus_subset, on synthetic matrices of
+increasing size written to a temporary directory. The time per character
+should stay about the same as the matrix grows. The character at a time
+loop nexus_subset used to use is timed too, on the smaller matrices.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+import numpy
+
+from nexus_subset import DNA, column_states, recode_tables, write_subset
+
+
+def make_matrix(ntax, nchar, seed=1):
+    """
+    A random matrix of the symbols nexus_from_munster uses
+    """
+    rand = numpy.random.RandomState(seed)
+    symbols = numpy.frombuffer(b'aaaabbc-?', dtype=numpy.uint8)
+    return symbols[rand.randint(0, len(symbols), size=(ntax, nchar))]
+
+
+def old_write(output_file, names, matrix, columns, values, tables, trans_name):
+    """
+    The character at a time output loop of the original nexus_subset
+    """
+    slot = dict((v, j) for j, v in enumerate(values.tolist()))
+    convs = [dict((v, chr(tables[i, j])) for v, j in slot.items()) for i in range(matrix.shape[1])]
+    stripes = dict((k, matrix[r].tobytes()) for r, k in enumerate(names))
+    keep = columns.tolist()
+    complex_chars = []
+    with open(output_file, 'w') as output:
+        output.write("#NEXUS\nbegin data;\ndimensions ntax={} nchar={};\n"
+                     "format missing=? gap=- matchchar=. datatype={};\nmatrix\n"
+                     .format(len(names), len(keep), trans_name))
+        for k in names:
+            output.write("{} ".format(k))
+            for i in keep:
+                if i not in complex_chars:
+                    output.write(convs[i][stripes[k][i]])
+            output.write('\n')
+        output.write(";\nEND;\n")
+
+
+def bench(ntax, sizes, old_limit):
+    tmp = tempfile.mkdtemp()
+    try:
+        print("{:>10} {:>12} {:>10} {:>14} {:>10}".format("chars", "cells", "write", "ns/cell", "old"))
+        for nchar in sizes:
+            matrix = make_matrix(ntax, nchar)
+            names = ["T{}".format(i) for i in range(ntax)]
+            values, counts = column_states(matrix)
+            tables, n_states = recode_tables(values, counts, DNA)
+            columns = numpy.nonzero(n_states <= len(DNA))[0]
+            output = os.path.join(tmp, 'out.nex')
+
+            start = time.time()
+            write_subset(output, names, matrix, columns, values, tables, 'dna')
+            secs = time.time() - start
+            cells = ntax * len(columns)
+
+            old = ''
+            if cells <= old_limit:
+                new_data = open(output).read()
+                start = time.time()
+                old_write(output, names, matrix, columns, values, tables, 'dna')
+                old = "{:.2f}s".format(time.time() - start)
+                assert open(output).read() == new_data
+
+            print("{:>10} {:>12} {:>9.2f}s {:>14.1f} {:>10}".format(nchar, cells, secs, secs / cells * 1e9, old))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the nexus_subset write phase on synthetic matrices")
+    parser.add_argument('-t', '--taxa', default=1000, type=int, help='Number of taxa')
+    parser.add_argument('-c', '--chars', default=[1000, 4000, 16000, 64000], type=int, nargs='+',
+                        help='Numbers of characters to try')
+    parser.add_argument('--old-limit', default=20000000, type=int,
+                        help='Only time the old loop for matrices with at most this many cells')
+    args = parser.parse_args()
+    bench(args.taxa, args.chars, args.old_limit)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark for the reading normalisation in import_from_munster_jn18_mysql,
+using a synthetic corpus of latin-transliterated readings repeated across
+many witnesses (as in a real apparatus).
+"""
+
+import random
+import time
+
+from import_from_munster_jn18_mysql import Translator
+
+
+def make_corpus(n_readings, n_witnesses, seed=1):
+    """
+    Return a list of readings, as they'd come out of the db one witness at a
+    time, made from n_readings distinct readings.
+    """
+    rand = random.Random(seed)
+    letters = 'abgdezhqiklmnxoprstufcyw'
+    distinct = []
+    for i in range(n_readings):
+        words = [''.join(rand.choice(letters) for _ in range(rand.randint(2, 9)))
+                 for _ in range(rand.randint(1, 6))]
+        rdg = ' '.join(words)
+        if rand.random() < 0.2:
+            rdg = '[{}]'.format(rdg)
+        distinct.append(rdg)
+
+    per_witness = max(1, n_readings // 10)
+    return [[rand.choice(distinct) for _ in range(per_witness)]
+            for _ in range(n_witnesses)]
+
+
+def old_translate(t, table, unicode_in):
+    """
+    The original character by character implementation
+    """
+    for x in unicode_in:
+        if x not in t.uni_from:
+            raise ValueError((x, unicode_in))
+    ret = unicode_in.translate(table)
+    return ret.replace('_', '')
+
+
+def bench(n_readings, n_witnesses):
+    corpus = make_corpus(n_readings, n_witnesses)
+    total = sum(len(x) for x in corpus)
+    print("{} readings ({} distinct) across {} witnesses".format(total, n_readings, n_witnesses))
+
+    t = Translator()
+    table = {ord(frm): t.uni_to[i] for i, frm in enumerate(t.uni_from)}
+    start = time.time()
+    old = [[old_translate(t, table, rdg) for rdg in fetch] for fetch in corpus]
+    old_time = time.time() - start
+
+    start = time.time()
+    new = [t.many(fetch) for fetch in corpus]
+    new_time = time.time() - start
+
+    assert old == new
+    print("  per character: {:.3f}s ({:.0f} readings/sec)".format(old_time, total / old_time))
+    print("  cached batch:  {:.3f}s ({:.0f} readings/sec)".format(new_time, total / new_time))
+    print("  speedup:       {:.1f}x".format(old_time / new_time))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the John 18 importer's Translator")
+    parser.add_argument('-r', '--readings', default=5000, type=int, help='Number of distinct readings')
+    parser.add_argument('-w', '--witnesses', default=500, type=int, help='Number of witnesses')
+    args = parser.parse_args()
+    bench(args.readings, args.witnesses)
@@ -4,7 +4,14 @@
 # otherwise you get a file that MrBayes can't read properly (for some reason...)
 # even though this should all be ascii......
 
-import re
+import csv
+import multiprocessing
+import os
+import tempfile
+
+import numpy
+
+from nexus_reader import read_nexus
 
 """
 Example abridged nexus file:
@@ -41,27 +48,6 @@ P78 -------------------------------aaadaaab-----------------abaabaaaaa----------
 END;
 """
 
-re_nexus = re.compile(r"""#nexus
-BEGIN Taxa;
-DIMENSIONS ntax=([0-9]+);
-TAXLABELS
-(.*?)
-;
-END;
-BEGIN Characters;
-DIMENSIONS nchar=([0-9]+);
-
-FORMAT
-    datatype=STANDARD
-    missing=-
-    gap=\?
-    symbols="(.*?)"
-;
-MATRIX
-(.*?);
-END;""", re.DOTALL)
-
-
 template = """#nexus
 BEGIN Taxa;
 DIMENSIONS ntax={ntax};
@@ -88,39 +74,54 @@ MISSING = '-'
 GAP = '?'
 
 
+def extant_counts(matrix):
+    """
+    Return the number of characters in each row of a byte matrix that
+    aren't MISSING or GAP, counting a few MB of rows at a time
+    """
+    nchar = matrix.shape[1]
+    counts = numpy.zeros(matrix.shape[0], dtype=numpy.int64)
+    step = max(1, 2 ** 22 // max(1, nchar))
+    for start in range(0, matrix.shape[0], step):
+        rows = matrix[start:start + step]
+        counts[start:start + step] = (nchar - (rows == ord(MISSING)).sum(axis=1)
+                                      - (rows == ord(GAP)).sum(axis=1))
+    return counts
+
+
 class Nexus(object):
     def __init__(self):
         self.taxa = []
         self.symbols = []
-        self.lines = {}
+        # One NexusMatrix block per file, in order - the rows are only joined
+        # up when writing
+        self.blocks = []
         self.nchar = 0
+        self._coverage = None
 
     def load(self, filename):
         """
         Load from existing nexus file
         """
         print("Loading {}".format(filename))
-        with open(filename) as f:
-            data = f.read()
-
-        match = re_nexus.match(data)
-        assert match, "Didn't match"
-        ntax = int(match.group(1))
-        taxa = match.group(2).splitlines()
-        assert len(taxa) == ntax, (len(taxa), ntax)
-        self.taxa = taxa
-        print(("  Loaded {} taxa: {}".format(ntax, ', '.join(taxa))))
-
-        self.nchar = int(match.group(3))
-        self.symbols = match.group(4).split()
+        block = read_nexus(filename)
+
+        # Use our missing and gap symbols
+        lut = numpy.arange(256, dtype=numpy.uint8)
+        lut[ord(block.missing)] = ord(MISSING)
+        lut[ord(block.gap)] = ord(GAP)
+        block.matrix = lut[block.matrix]
+
+        self.taxa = list(block.taxa)
+        print(("  Loaded {} taxa: {}".format(block.ntax, ', '.join(self.taxa))))
+
+        self.nchar = block.nchar
+        self.symbols = block.symbols
         print("  Loaded {} characters and {} symbols ({})".format(
             self.nchar, len(self.symbols), ', '.join(self.symbols)))
 
-        for stripe in match.group(5).splitlines():
-            taxon, chars = stripe.split(' ', 1)
-            assert len(chars) == self.nchar
-            self.lines[taxon] = chars
-
+        self.blocks = [block]
+        self._coverage = None
         print("  Loaded matrix")
 
     def add_nexus(self, other_nexus):
@@ -128,22 +129,66 @@ class Nexus(object):
         Add data from another nexus file object to this one, creating a larger
         combined nexus file.
         """
+        taxa = set(self.taxa)
         for t in other_nexus.taxa:
-            if t not in self.taxa:
+            if t not in taxa:
                 self.taxa.append(t)
+                taxa.add(t)
 
         self.symbols = sorted(set(self.symbols + other_nexus.symbols))
 
         self.nchar += other_nexus.nchar
+        self.blocks.extend(other_nexus.blocks)
+        self._coverage = None
 
-        new_lines = {}
+    def line(self, taxon):
+        """
+        Return the full row of characters for a taxon, with missing blocks
+        filled with MISSING
+        """
+        parts = []
+        for block in self.blocks:
+            i = block.index.get(taxon)
+            parts.append(MISSING * block.nchar if i is None else block.matrix[i].tobytes().decode('ascii'))
+        return ''.join(parts)
 
-        for t in self.taxa:
-            line = self.lines.get(t, MISSING * self.nchar)
-            line += other_nexus.lines.get(t, MISSING * other_nexus.nchar)
-            new_lines[t] = line
+    def coverage(self):
+        """
+        Return an array of the number of characters each taxon (in
+        self.taxa order) is extant in
+        """
+        # Cached until more data is loaded or added
+        if self._coverage is not None:
+            return self._coverage
+        position = {t: i for i, t in enumerate(self.taxa)}
+        counts = numpy.zeros(len(self.taxa), dtype=numpy.int64)
+        for block in self.blocks:
+            rows = [position[t] for t in block.taxa]
+            counts[rows] += extant_counts(block.matrix)
+        self._coverage = counts
+        return counts
+
+    def coverage_summary(self, thresholds):
+        """
+        Return {percentage: number of taxa extant in at least that
+        percentage of characters} for each of the thresholds
+        """
+        thresholds = list(thresholds)
+        targets = numpy.array(thresholds, dtype=float) * self.nchar / 100.0
+        kept = (self.coverage()[None, :] >= targets[:, None]).sum(axis=1)
+        return dict(zip(thresholds, kept.tolist()))
 
-        self.lines = new_lines
+    def write_coverage_report(self, filename):
+        """
+        Write a CSV file of each taxon's extant characters (count and
+        percentage)
+        """
+        counts = self.coverage()
+        with open(filename, 'w', newline='') as f:
+            out = csv.writer(f)
+            out.writerow(['taxon', 'extant', 'percentage'])
+            for t, n in zip(self.taxa, counts.tolist()):
+                out.writerow([t, n, "{:.2f}".format(n * 100.0 / self.nchar if self.nchar else 0)])
 
     def write(self, output, extant_perc=0):
         """
@@ -153,49 +198,167 @@ class Nexus(object):
         target_chars = self.nchar * extant_perc / 100.0
         print("Only including taxa extant in {} ({}%) of characters".format(target_chars, extant_perc))
 
-        #self.taxa = self.taxa[:3] ## FIXME
-        #self.nchar = 1000 ##FIXME
-
-        taxa = self.taxa
-
-        matrix = []
-        for t in self.taxa:
-            line = self.lines[t]
-            extant = [x for x in line if x not in (MISSING, GAP)]
-            if len(extant) < target_chars:
-                print(("Deleting {} as it's only extant in {} characters".format(t, len(extant))))
-                del taxa[taxa.index(t)]
-                continue
-            matrix.append('{} {}'.format(t, line[:self.nchar]))##FIXME
-
-        data = template.format(ntax=len(taxa),
-                               taxa='\n'.join(taxa),
-                               nchar=self.nchar,
-                               symbols=' '.join(self.symbols),
-                               matrix='\n'.join(matrix),
-                               missing=MISSING,
-                               gap=GAP)
+        taxa = []
+        for t, extant in zip(self.taxa, self.coverage().tolist()):
+            if extant < target_chars:
+                print(("Deleting {} as it's only extant in {} characters".format(t, extant)))
+            else:
+                taxa.append(t)
+
+        header, footer = template.split('{matrix}')
         with open(output, 'w') as f:
-            f.write(str(data))
+            f.write(header.format(ntax=len(taxa),
+                                  taxa='\n'.join(taxa),
+                                  nchar=self.nchar,
+                                  symbols=' '.join(self.symbols),
+                                  missing=MISSING,
+                                  gap=GAP))
+            for i, t in enumerate(taxa):
+                if i:
+                    f.write('\n')
+                f.write('{} {}'.format(t, self.line(t)))
+            f.write(footer)
 
         print(("Written combined nexus file {}".format(output)))
 
 
-def combine(input_files, output_file, perc):
-    nex = Nexus()
-    for i in input_files:
-        n = Nexus()
-        n.load(i)
-        nex.add_nexus(n)
+class MemmapNexus(Nexus):
+    """
+    A combined Nexus held in a memory mapped (taxa x nchar) byte file, so
+    only one input file needs to be in memory at a time
+    """
+    def __init__(self, directory=None):
+        super().__init__()
+        self.directory = directory
+        self.filename = None
+        self.matrix = None
+        self.position = {}
 
+    def build(self, input_files):
+        """
+        Combine the input files into the memory mapped matrix - first
+        reading their headers to find its size, then copying in each file's
+        block of characters in turn.
+        """
+        for filename in input_files:
+            header = read_nexus(filename, header_only=True)
+            for t in header.taxa:
+                if t not in self.position:
+                    self.position[t] = len(self.taxa)
+                    self.taxa.append(t)
+            self.symbols = sorted(set(self.symbols + header.symbols))
+            self.nchar += header.nchar
+        print("Combining {} taxa and {} characters".format(len(self.taxa), self.nchar))
+
+        fd, self.filename = tempfile.mkstemp(suffix='.matrix', dir=self.directory)
+        os.close(fd)
+        self.matrix = numpy.memmap(self.filename, dtype=numpy.uint8, mode='w+',
+                                   shape=(len(self.taxa), self.nchar))
+        self.matrix[:] = ord(MISSING)
+
+        offset = 0
+        for filename in input_files:
+            block = load_nexus(filename).blocks[0]
+            rows = [self.position[t] for t in block.taxa]
+            self.matrix[rows, offset:offset + block.nchar] = block.matrix
+            offset += block.nchar
+            del block
+        self.matrix.flush()
+
+    def close(self):
+        """
+        Remove the memory mapped file
+        """
+        if self.filename:
+            self.matrix = None
+            os.remove(self.filename)
+            self.filename = None
+
+    def line(self, taxon):
+        return self.matrix[self.position[taxon]].tobytes().decode('ascii')
+
+    def coverage(self):
+        # The matrix doesn't change once built, so only count it once
+        if self._coverage is None:
+            self._coverage = extant_counts(self.matrix)
+        return self._coverage
+
+
+def load_nexus(filename):
+    n = Nexus()
+    n.load(filename)
+    return n
+
+
+def combine(input_files, output_file, perc, thresholds=(), jobs=1, out_of_core=False,
+            scratch_dir=None):
+    """
+    Combine the input files, writing the taxa extant in perc% of characters
+    to output_file, and a coverage report to output_file.coverage.csv. The
+    number of taxa that other thresholds (percentages) would keep is shown.
+
+    If jobs is more than 1 then the input files are read by a pool of that
+    many processes (but still combined in order).
+
+    If out_of_core is True then the files are combined in a memory mapped
+    file (see MemmapNexus) in scratch_dir (default: the system temporary
+    directory), one file at a time.
+    """
+    if out_of_core:
+        nex = MemmapNexus(scratch_dir)
+        try:
+            nex.build(input_files)
+            write_combined(nex, output_file, perc, thresholds)
+        finally:
+            nex.close()
+        return
+
+    nex = Nexus()
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            for n in pool.imap(load_nexus, input_files):
+                nex.add_nexus(n)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for i in input_files:
+            nex.add_nexus(load_nexus(i))
+    write_combined(nex, output_file, perc, thresholds)
+
+
+def write_combined(nex, output_file, perc, thresholds):
+    """
+    Write the combined nexus file and its coverage report
+    """
     nex.write(output_file, perc)
 
+    report = "{}.coverage.csv".format(output_file)
+    nex.write_coverage_report(report)
+    print("Written coverage report {}".format(report))
+    for threshold, ntaxa in sorted(nex.coverage_summary(thresholds).items()):
+        print("  {} taxa are extant in {}% of characters".format(ntaxa, threshold))
+
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('-e', '--extant_perc', default=0, type=int, help='Percentage of variant units a witness must attest to be included')
+    parser.add_argument('-t', '--threshold', action='append', default=[], type=float, dest='thresholds',
+                        metavar='PERC', help='Also show how many taxa this extant percentage would '
+                                             'include (may be given more than once)')
+    parser.add_argument('-j', '--jobs', default=1, type=int,
+                        help='Number of processes to read the input files with (default 1)')
+    parser.add_argument('--out-of-core', default=False, action='store_true',
+                        help='Combine the files in a memory mapped file rather than in memory, '
+                             'for inputs too big to hold all at once')
+    parser.add_argument('--scratch-dir',
+                        help='Directory for the --out-of-core file (default: the system temporary directory)')
     parser.add_argument('input_file', nargs='+', help='Input nexus files')
     parser.add_argument('output_file', help='Filename to save combined nexus data to')
     args = parser.parse_args()
-    combine(args.input_file, args.output_file, args.extant_perc)
+    if args.out_of_core and args.jobs > 1:
+        parser.error("--jobs can't be used with --out-of-core")
+    combine(args.input_file, args.output_file, args.extant_perc, args.thresholds, args.jobs,
+            args.out_of_core, args.scratch_dir)
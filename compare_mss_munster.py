@@ -4,34 +4,25 @@
 Compare the text of two (or more) manuscripts in a Muenster mysql database
 """
 
-import MySQLdb
 import itertools
 import sys
 
+from munster_dialects import get_vu_refs
+from munster_storage import add_storage_arguments, get_storage, check_map_indexes
 
-def compare(host, db, user, password, table, witnesses):
+
+def compare(storage, table, witnesses):
     """
-    Connect to the mysql db and loop through what we find
+    Connect to the db and loop through what we find
     """
     assert len(witnesses) == 2
-    print("\nComparison of {} in db {}:{}".format(', '.join(witnesses), db, table))
+    print("\nComparison of {} in db {}:{}".format(', '.join(witnesses), storage, table))
 
-    db = MySQLdb.connect(host=host, user=user, passwd=password, db=db, charset='utf8')
+    db = storage.connect()
+    check_map_indexes(storage, db, table)
     cur = db.cursor()
 
-    vu_mapping = {}
-    cur.execute("SELECT id, vbeg, vend, wbeg, wend FROM {}_ed_vus".format(table))
-    for row in cur.fetchall():
-        i, bv, ev, bw, ew = row
-        ref = "{}/".format(bv)
-        if bv == ev:
-            if bw == ew:
-                ref += str(bw)
-            else:
-                ref += "{}-{}".format(bw, ew)
-        else:
-            ref += "{}-{}/{}".format(bw, ev, ew)
-        vu_mapping[i] = ref
+    vu_mapping = get_vu_refs(db, table)
 
     query = """SELECT A.vu_id, A.greek, B.greek, A.ident, B.ident FROM {}_ed_map A
                INNER JOIN {}_ed_map B
@@ -72,20 +63,15 @@ if __name__ == "__main__":
     example = "EXAMPLE: {} -u root -p password -s localhost -d \\\n ECM_23_2 -t Att1J_2plus 03 04".format(sys.argv[0])
     parser = argparse.ArgumentParser(epilog=example)
     parser.add_argument('witness', nargs='+', help='Witnesses to compare')
-    parser.add_argument('-u', '--mysql-user', required=True, help='User to connect to mysql with')
-    parser.add_argument('-p', '--mysql-password', required=True, help='Password to connect to mysql with')
-    parser.add_argument('-s', '--mysql-host', required=True, help='Host to connect to')
-    parser.add_argument('-d', '--mysql-db', required=True, help='Database to connect to')
+    add_storage_arguments(parser, reader=True)
     parser.add_argument('-t', '--mysql-table', required=True, help='Table name to get data from')
 
     args = parser.parse_args()
+    storage = get_storage(parser, args)
 
     diffs = []
     for pair in itertools.combinations(args.witness, 2):
-        diffs.append(compare(args.mysql_host,
-                             args.mysql_db,
-                             args.mysql_user,
-                             args.mysql_password,
+        diffs.append(compare(storage,
                              args.mysql_table,
                              [x.replace(',', '') for x in pair]))
     print("Summary of differences of pairs: " + ', '.join(str(x) for x in diffs))
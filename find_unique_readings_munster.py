@@ -3,37 +3,28 @@
 Find readings unique to two (or more) manuscripts in a Muenster mysql database
 """
 
-import MySQLdb
 import sys
 import itertools
 
+from munster_dialects import get_vu_refs
+from munster_storage import add_storage_arguments, get_storage, check_map_indexes
 
-def compare(host, db, user, password, table, witnesses, quiet=False):
+
+def compare(storage, table, witnesses, quiet=False):
     """
-    Connect to the mysql db and loop through what we find
+    Connect to the db and loop through what we find
     """
     if not quiet:
-        print("\n\nLooking for unique readings in {} in db {}:{}".format(', '.join(witnesses), db, table))
+        print("\n\nLooking for unique readings in {} in db {}:{}".format(', '.join(witnesses), storage, table))
     else:
         sys.stdout.write('+')
         sys.stdout.flush()
 
-    db = MySQLdb.connect(host=host, user=user, passwd=password, db=db, charset='utf8')
+    db = storage.connect()
+    check_map_indexes(storage, db, table)
     cur = db.cursor()
 
-    vu_mapping = {}
-    cur.execute("SELECT id, vbeg, vend, wbeg, wend FROM {}_ed_vus".format(table))
-    for row in cur.fetchall():
-        i, bv, ev, bw, ew = row
-        ref = "{}/".format(bv)
-        if bv == ev:
-            if bw == ew:
-                ref += str(bw)
-            else:
-                ref += "{}-{}".format(bw, ew)
-        else:
-            ref += "{}-{}/{}".format(bw, ev, ew)
-        vu_mapping[i] = ref
+    vu_mapping = get_vu_refs(db, table)
 
     # Let's get all the readings for our first witness
     query = """SELECT vu_id, ident, greek FROM {}_ed_map
@@ -64,33 +55,25 @@ if __name__ == "__main__":
     example = "EXAMPLE: {} -u root -p password -s localhost \\\n-d ECM_23_2 -t Att1J_2plus 03".format(sys.argv[0])
     parser = argparse.ArgumentParser(epilog=example)
     parser.add_argument('witness', nargs='+', help='Witnesses to compare')
-    parser.add_argument('-u', '--mysql-user', required=True, help='User to connect to mysql with')
-    parser.add_argument('-p', '--mysql-password', required=True, help='Password to connect to mysql with')
-    parser.add_argument('-s', '--mysql-host', required=True, help='Host to connect to')
-    parser.add_argument('-d', '--mysql-db', required=True, help='Database to connect to')
+    add_storage_arguments(parser, reader=True)
     parser.add_argument('-t', '--mysql-table', required=True, help='Table name to get data from')
     parser.add_argument('--subsets', default=False, action='store_true', help='Try to find unique readings in all possible subsets - THIS COULD TAKE A LONG TIME')
     parser.add_argument('-q', '--quiet', default=False, action='store_true', help='Suppress lots of output')
 
     args = parser.parse_args()
+    storage = get_storage(parser, args)
 
     witnesses = [x.replace(',', '') for x in args.witness]
 
     if args.subsets:
         for size in range(2, len(args.witness) + 1):
             for subset in itertools.combinations(witnesses, size):
-                compare(args.mysql_host,
-                        args.mysql_db,
-                        args.mysql_user,
-                        args.mysql_password,
+                compare(storage,
                         args.mysql_table,
                         list(subset),
                         args.quiet)
     else:
-        compare(args.mysql_host,
-                args.mysql_db,
-                args.mysql_user,
-                args.mysql_password,
+        compare(storage,
                 args.mysql_table,
                 witnesses,
                 args.quiet)
@@ -1,11 +1,22 @@
 # -*- coding: utf-8 -*-
 
 import sys
-import MySQLdb
+import re
+import functools
+import multiprocessing
+
+from munster_storage import (add_storage_arguments, get_storage, create_map_indexes,
+                             drop_map_tables, is_compact, compact_map)
+from munster_dialects import JN18_VU_COLUMNS as VU_COLUMNS
+from munster_bulk import BulkFile, PhaseStats, extract_vus
+
+
+DEFAULT_CACHE_SIZE = 100000
+DEFAULT_BATCH_SIZE = 10000
 
 
 class Translator(object):
-    def __init__(self):
+    def __init__(self, cache_size=DEFAULT_CACHE_SIZE):
         # We have latin text, that corresponds to greek
         #  and square brackets for supplied text (which we'll just accept and remove the brackets)
         #  and full stops representing missing text, which we'll replace with spaces
@@ -15,174 +26,482 @@ class Translator(object):
 
         self.uni_from = '.[]() abgdezhqiklmnxoprs~tufcyw0123456789:-ˆ¿¯,…?/'
         self.uni_to = '___() αβγδεζηθικλμνξοπρσςτυφχψω0123456789:-_______'
-        self.translate_table = {ord(frm): self.uni_to[i]
+        # '_' means remove the character
+        self.translate_table = {ord(frm): None if self.uni_to[i] == '_' else self.uni_to[i]
                                 for i, frm in enumerate(self.uni_from)}
+        self.invalid = re.compile('[^{}]'.format(re.escape(self.uni_from)))
+
+        # Most readings occur in many witnesses, so remember the recent ones
+        self.translate = functools.lru_cache(maxsize=cache_size)(self._translate)
+
+    def _translate(self, unicode_in):
+        bad = self.invalid.search(unicode_in)
+        if bad:
+            print(bad.group())
+            print(unicode_in)
+            raise ValueError((bad.group(), unicode_in))
+        return unicode_in.translate(self.translate_table)
 
     def __call__(self, unicode_in):
-        for x in unicode_in:
-            if x not in self.uni_from:
-                print(x)
-                print(unicode_in)
-                raise ValueError((x, unicode_in))
-        ret = unicode_in.translate(self.translate_table)
-        ret = ret.replace('_', '')
-        return ret
+        return self.translate(unicode_in)
+
+    def many(self, readings):
+        """
+        Translate a list of readings (e.g. from one fetch), passing None
+        through untouched.
+        """
+        done = {None: None}
+        for rdg in readings:
+            if rdg not in done:
+                done[rdg] = self.translate(rdg)
+        return [done[rdg] for rdg in readings]
 
 
 translate = Translator()
 
 
-def load_witness(witness, cur, table):
+def load_vus(cur, table):
+    """
+    Load the whole {table}_ed_vus table into a dict keyed on the VU columns
+    """
+    cur.execute("SELECT id, {} FROM {}_ed_vus".format(', '.join(VU_COLUMNS), table))
+    return {tuple(row[1:]): row[0] for row in cur.fetchall()}
+
+
+def get_reading(obj):
+    """
+    Return (rdg, ident) for a row of the source table, or None if the row
+    should be ignored. For a real reading rdg is the latin text to translate
+    into greek and ident is None, as it needs finding or making.
+    """
+    assert obj['BCH'] == obj['ECH'], obj
+    assert obj['B'] == 4, obj
+    assert obj['BCH'] == 18, obj
+
+    rdg = obj['RDG'].strip()
+
+    # Square brackets...
+    rdg = rdg.replace('»', '[')
+    rdg = rdg.replace('¼', ']')
+
+    if obj['RDG'] == '\x88 \xbb2\xbca\r':
+        print("Wierd: {}".format(obj['RDG']))
+        return None
+    if obj['SUFF'] == '*':
+        # Original firsthand reading (before he corrected it)
+        return None
+
+    assert obj['SUFF'].strip() == '', obj
+
+    if "/lectionary influence/" in rdg:
+        rdg = rdg.replace("/lectionary influence/", "")
+
+    if rdg == 'DEF':
+        # Text deficient (lacuna, gap?)...
+        return None, -1  # NOTE - this isn't the same as RNR == -1...
+
+    elif rdg == 'SINE ADD':
+        # Addition in another witness not present here
+        return None, -2
+
+    else:
+        # To be translated to unicode greek
+        return str(rdg.lower()), None
+
+
+class IdentAllocator(object):
+    """
+    Find or make the ident for each reading of a variant unit, keeping
+    {vu_id: {greek: ident}} in memory rather than searching {table}_ed_map.
+    """
+    def __init__(self):
+        self.idents = {}
+        self.max_ident = {}
+
+    def seed(self, cur, table):
+        """
+        Pick up the idents already in the {table}_ed_map table
+        """
+        cur.execute("SELECT vu_id, greek, ident FROM {}_ed_map WHERE ident > 0".format(table))
+        for vu_id, greek, ident in cur.fetchall():
+            self.idents.setdefault(vu_id, {}).setdefault(greek, ident)
+            self.max_ident[vu_id] = max(ident, self.max_ident.get(vu_id, 0))
+
+    def __call__(self, vu_id, greek):
+        vu_idents = self.idents.setdefault(vu_id, {})
+        if greek not in vu_idents:
+            ident = self.max_ident.get(vu_id, 0) + 1
+            self.max_ident[vu_id] = ident
+            vu_idents[greek] = ident
+        return vu_idents[greek]
+
+
+def allocate_idents(cur, table, vus, idents):
+    """
+    Make the idents for every reading in the table up front. Needed when
+    several processes are loading witnesses at once, as they can't share
+    one IdentAllocator.
+    """
+    cur.execute("SELECT * FROM {} ORDER BY HS".format(table))
+    field_names = [i[0] for i in cur.description]
+    for row in cur.fetchall():
+        obj = {field_names[i]: val for i, val in enumerate(row)}
+        try:
+            reading = get_reading(obj)
+            if reading is None or reading[1] is not None:
+                continue
+            greek = translate(reading[0])
+        except Exception:
+            # load_witnesses will report this
+            continue
+        idents(vus[tuple(obj[x] for x in VU_COLUMNS)], greek)
+
+
+def witness_rows(witness, cur, table, vus, idents):
     """
-    Load a particular witness from the db
+    Read a particular witness from the db, returning the rows for the
+    {table}_ed_map table and using idents (an IdentAllocator) to find or
+    make the ident for each reading.
     """
     cur.execute("SELECT * FROM {} WHERE HS = %s".format(table), (witness, ))
     field_names = [i[0] for i in cur.description]
-    attestations = []
-    while True:
-        row = cur.fetchone()
-        if row is None:
-            break
-        attestations.append(row)
+    attestations = cur.fetchall()
 
+    readings = []
     for row in attestations:
         obj = {field_names[i]: val for i, val in enumerate(row)}
-        assert obj['BCH'] == obj['ECH'], obj
-        assert obj['B'] == 4, obj
-        assert obj['BCH'] == 18, obj
+        reading = get_reading(obj)
+        if reading is not None:
+            readings.append((obj, reading[0], reading[1]))
 
-        rdg = obj['RDG'].strip()
+    # Translate to unicode greek
+    greeks = translate.many([rdg for obj, rdg, ident in readings])
 
-        # Square brackets...
-        rdg = rdg.replace('»', '[')
-        rdg = rdg.replace('¼', ']')
+    map_rows = []
+    for (obj, rdg, ident), greek in zip(readings, greeks):
+        try:
+            vu_id = vus[tuple(obj[x] for x in VU_COLUMNS)]
+        except KeyError:
+            raise ValueError("Can't find vu")
 
-        if obj['RDG'] == '\x88 \xbb2\xbca\r':
-            print("Wierd: {}".format(obj['RDG']))
-            continue
-        if obj['SUFF'] == '*':
-            # Original firsthand reading (before he corrected it)
+        if ident is None:
+            ident = idents(vu_id, greek)
+
+        map_rows.append((witness, vu_id, greek, ident))
+
+    return map_rows
+
+
+def save_witnesses(cur, table, map_rows, checksums, batch_size):
+    """
+    Insert map_rows into {table}_ed_map (batch_size rows at a time) for the
+    witnesses in checksums, and record the witnesses' checksums in the
+    {table}_ed_state table. Any old rows for the witnesses must have been
+    removed already (see witnesses_to_load).
+    """
+    query = """INSERT INTO {}_ed_map (witness, vu_id, greek, ident)
+               VALUES (%s, %s, %s, %s);""".format(table)
+    for i in range(0, len(map_rows), batch_size):
+        cur.executemany(query, map_rows[i:i + batch_size])
+    cur.executemany("REPLACE INTO {}_ed_state (witness, checksum) VALUES (%s, %s)".format(table),
+                    [(str(wit), checksum) for wit, checksum in checksums.items()])
+
+
+def load_bulk(storage, db, table, vus, idents, witnesses):
+    """
+    Write the readings of the given witnesses ({witness: checksum}) to a
+    temporary file, then load it in one go with storage.load_file. Witnesses
+    that can't be read are reported and skipped.
+    """
+    cur = db.cursor()
+    stats = PhaseStats("Map generation")
+    loaded = {}
+    with BulkFile() as out:
+        for i, (wit, checksum) in enumerate(witnesses.items()):
+            sys.stdout.write("\r{} / {}: {}     ".format(i + 1, len(witnesses), wit))
+            sys.stdout.flush()
+            try:
+                map_rows = witness_rows(wit, cur, table, vus, idents)
+            except Exception as e:
+                print(e)
+                print()
+                continue
+            for row in map_rows:
+                out.write(row)
+            loaded[wit] = checksum
+        out.close()
+        print()
+        stats.finish(out.rows, out.bytes)
+
+        stats = PhaseStats("Load")
+        storage.load_file(cur, out.name, "{}_ed_map".format(table),
+                          ["witness", "vu_id", "greek", "ident"])
+        cur.executemany("REPLACE INTO {}_ed_state (witness, checksum) VALUES (%s, %s)".format(table),
+                        [(str(wit), checksum) for wit, checksum in loaded.items()])
+        db.commit()
+        stats.finish(out.rows, out.bytes)
+
+
+def source_checksums(cur, table):
+    """
+    Return {witness: checksum} for the witnesses in the source table, where
+    the checksum (computed inside MySQL) changes if any of the witness's
+    rows do.
+    """
+    cur.execute("""SELECT HS, COUNT(*),
+                       BIT_XOR(CRC32(CONCAT_WS('|', B, BCH, ECH, BV, EV, BW, EW, RDG, SUFF)))
+                   FROM {}
+                   GROUP BY HS;""".format(table))
+    return {row[0]: "{}:{}".format(row[1], row[2]) for row in cur.fetchall()}
+
+
+def witnesses_to_load(cur, table, checksums):
+    """
+    Compare the source checksums with the {table}_ed_state table, removing
+    any witnesses that have gone from the source, and the old rows of those
+    that have changed. Return the ones that are new or changed.
+    """
+    cur.execute("SELECT witness, checksum FROM {}_ed_state".format(table))
+    loaded = dict(cur.fetchall())
+
+    current = set(str(wit) for wit in checksums)
+    removed = [wit for wit in loaded if wit not in current]
+    if removed:
+        print("Removing {} witness(es) no longer in the source table".format(len(removed)))
+        cur.executemany("DELETE FROM {}_ed_map WHERE witness = %s".format(table),
+                        [(wit, ) for wit in removed])
+        cur.executemany("DELETE FROM {}_ed_state WHERE witness = %s".format(table),
+                        [(wit, ) for wit in removed])
+
+    todo = {wit: checksum for wit, checksum in checksums.items()
+            if loaded.get(str(wit)) != checksum}
+    # Only witnesses in {table}_ed_state have rows to replace
+    changed = [wit for wit in todo if str(wit) in loaded]
+    if changed:
+        cur.executemany("DELETE FROM {}_ed_map WHERE witness = %s".format(table),
+                        [(wit, ) for wit in changed])
+        cur.executemany("DELETE FROM {}_ed_state WHERE witness = %s".format(table),
+                        [(str(wit), ) for wit in changed])
+    print("{} of {} witnesses are new or changed".format(len(todo), len(checksums)))
+    return todo
+
+
+def load_witnesses(db, cur, table, vus, idents, witnesses, batch_size, progress):
+    """
+    Load the given witnesses ({witness: checksum}), committing every
+    batch_size rows. Witnesses that can't be read (see witness_rows) are
+    reported and skipped. The progress function is called with each witness
+    as it is loaded.
+    """
+    pending = []
+    pending_checksums = {}
+    for wit, checksum in witnesses.items():
+        progress(wit)
+        try:
+            pending.extend(witness_rows(wit, cur, table, vus, idents))
+        except Exception as e:
+            print(e)
+            print()
             continue
+        pending_checksums[wit] = checksum
 
-        assert obj['SUFF'].strip() == '', obj
-
-        if "/lectionary influence/" in rdg:
-            rdg = rdg.replace("/lectionary influence/", "")
-
-        if rdg == 'DEF':
-            # Text deficient (lacuna, gap?)...
-            greek = None
-            ident = -1  # NOTE - this isn't the same as RNR == -1...
-
-        elif rdg == 'SINE ADD':
-            # Addition in another witness not present here
-            greek = None
-            ident = -2
-
-        else:
-            # Translate to unicode greek
-            greek = translate(str(rdg.lower()))
-            ident = None
-
-        # Find ident or make a new one
-        cur.execute("""SELECT id FROM {}_ed_vus WHERE
-                        BV=%s AND EV=%s AND BW=%s AND EW=%s""".format(table),
-                    (obj['BV'], obj['EV'], obj['BW'], obj['EW']))
-        for row in cur.fetchall():
-            vu_id = row[0]
-            break
-        else:
-            raise ValueError("Can't find vu")
+        if len(pending) >= batch_size:
+            save_witnesses(cur, table, pending, pending_checksums, batch_size)
+            db.commit()
+            pending = []
+            pending_checksums = {}
 
-        if ident is None:
-            cur.execute("SELECT ident FROM {}_ed_map WHERE vu_id=%s AND greek=%s".format(table),
-                        (vu_id, greek))
-            for row in cur.fetchall():
-                ident = row[0]
-                break
-            else:
-                cur.execute("SELECT MAX(ident) FROM {}_ed_map WHERE vu_id=%s".format(table),
-                            (vu_id, ))
-                row = cur.fetchone()
-                if row[0] is None:
-                    ident = 1
-                else:
-                    ident = row[0] + 1
-
-        cur.execute("""INSERT INTO {}_ed_map (witness, vu_id, greek, ident)
-                        VALUES (%s, %s, %s, %s);""".format(table),
-                    (witness, vu_id, greek, ident))
-
-
-def load_all(host, db, user, password, table):
-    """
-    Connect to the mysql db and loop through what we find
-    """
-    db = MySQLdb.connect(host=host, user=user, passwd=password, db=db, charset='utf8')
+    save_witnesses(cur, table, pending, pending_checksums, batch_size)
+    db.commit()
+
+
+# Per-process state for the worker pool
+_worker = {}
+
+
+def _init_worker(storage, table, vus, idents, counter):
+    """
+    Give each worker process its own connection
+    """
+    db = storage.connect()
+    _worker.update(db=db, cur=db.cursor(), table=table, vus=vus,
+                   idents=idents, counter=counter)
+
+
+def _count_witness(wit):
+    with _worker['counter'].get_lock():
+        _worker['counter'].value += 1
+
+
+def _load_chunk(args):
+    witnesses, batch_size = args
+    load_witnesses(_worker['db'], _worker['cur'], _worker['table'], _worker['vus'],
+                   _worker['idents'], witnesses, batch_size, _count_witness)
+
+
+def load_parallel(storage, table, vus, idents, witnesses, batch_size, workers):
+    """
+    Spread the witnesses across a pool of worker processes, each with its own
+    connection to the db.
+    """
+    items = sorted(witnesses.items())
+    # Several chunks per worker, so the pool stays busy to the end
+    size = max(1, len(items) // (workers * 4))
+    chunks = [(dict(items[i:i + size]), batch_size) for i in range(0, len(items), size)]
+
+    counter = multiprocessing.Value('i', 0)
+    pool = multiprocessing.Pool(workers, _init_worker,
+                                (storage, table, vus, idents, counter))
+    try:
+        result = pool.map_async(_load_chunk, chunks)
+        while not result.ready():
+            result.wait(1)
+            sys.stdout.write("\r{} / {}     ".format(counter.value, len(witnesses)))
+            sys.stdout.flush()
+        result.get()
+    finally:
+        pool.close()
+        pool.join()
+
+
+def load_all(storage, table, workers=1, incremental=False, compact=False, bulk=False,
+             batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Connect to the db and loop through what we find
+
+    If incremental is True then the existing tables are kept, and only
+    witnesses that are new or have changed since they were last loaded
+    (according to the {table}_ed_state table) are loaded.
+
+    If compact is True then {table}_ed_map is converted to the compact
+    schema once it's loaded (see munster_storage.compact_map).
+
+    If bulk is True then the variant units and readings are written to
+    temporary files and loaded with LOAD DATA LOCAL INFILE, reporting the
+    throughput of each phase.
+
+    Otherwise the readings are inserted and committed batch_size rows at a
+    time.
+    """
+    db = storage.connect(local_infile=bulk)
     cur = db.cursor()
 
-    cur.execute("DROP TABLE IF EXISTS ed_map;")
-    cur.execute("DROP TABLE IF EXISTS ed_vus;")
-    cur.execute("DROP TABLE IF EXISTS {}_ed_map;".format(table))
-    cur.execute("DROP TABLE IF EXISTS {}_ed_vus;".format(table))
+    if not incremental:
+        cur.execute("DROP TABLE IF EXISTS ed_map;")
+        cur.execute("DROP TABLE IF EXISTS ed_vus;")
+        drop_map_tables(storage, db, table)
+    elif is_compact(storage, db, table):
+        raise ValueError("{}_ed_map is compact - it can't be loaded incrementally".format(table))
 
     # Phase 1: load variant units
-    cur.execute("""CREATE TABLE {}_ed_vus (
-                        id INT AUTO_INCREMENT KEY,
+    cur.execute("""CREATE TABLE IF NOT EXISTS {}_ed_vus (
+                        id {},
                         BV INT,
                         EV INT,
                         BW INT,
-                        EW INT);""".format(table))
-
-    cur.execute("""INSERT INTO {}_ed_vus (BV, EV, BW, EW)
-                       SELECT BV, EV, BW, EW
-                       FROM {} GROUP BY BV, EV, BW, EW;""".format(table, table))
-
-    cur.execute("""CREATE TABLE {}_ed_map (
+                        EW INT);""".format(table, storage.autoincrement_key))
+
+    if bulk:
+        extract_vus(storage, db, table, VU_COLUMNS, VU_COLUMNS, load_vus(cur, table))
+    else:
+        # Only add VUs we don't already have (for incremental loads)
+        cur.execute("""INSERT INTO {table}_ed_vus (BV, EV, BW, EW)
+                           SELECT BV, EV, BW, EW
+                           FROM {table} s
+                           WHERE NOT EXISTS (
+                               SELECT 1 FROM {table}_ed_vus v
+                               WHERE v.BV {eq} s.BV AND v.EV {eq} s.EV
+                               AND v.BW {eq} s.BW AND v.EW {eq} s.EW)
+                           GROUP BY BV, EV, BW, EW;""".format(table=table, eq=storage.null_safe_eq))
+
+    cur.execute("""CREATE TABLE IF NOT EXISTS {}_ed_map (
                     witness TEXT NOT NULL,
                     vu_id INT NOT NULL,
-                    greek TEXT CHARACTER SET UTF8,
+                    greek {},
                     ident INT NOT NULL,
 
                     FOREIGN KEY (vu_id)
                         REFERENCES {}_ed_vus(id)
-                    );""".format(table, table))
+                    );""".format(table, storage.utf8_text, table))
+
+    # Which witnesses have been loaded, and from what source data
+    cur.execute("""CREATE TABLE IF NOT EXISTS {}_ed_state (
+                    witness VARCHAR(32) NOT NULL PRIMARY KEY,
+                    checksum VARCHAR(64) NOT NULL
+                    );""".format(table))
+    db.commit()
 
     # Phase 2: load readings
-    cur.execute("SELECT DISTINCT HS FROM {};".format(table))
+    witnesses = source_checksums(cur, table)
+    if incremental:
+        witnesses = witnesses_to_load(cur, table, witnesses)
+        db.commit()
 
-    witnesses = set()
-    for row in cur.fetchall():
-        witnesses.add(row[0])
+    vus = load_vus(cur, table)
+
+    idents = IdentAllocator()
+    idents.seed(cur, table)
 
     print()
-    for i, wit in enumerate(witnesses):
-        sys.stdout.write("\r{} / {}: {}     ".format(i + 1, len(witnesses), wit))
-        sys.stdout.flush()
-        try:
-            load_witness(wit, cur, table)
-        except Exception as e:
-            print(e)
-            print()
-        else:
-            db.commit()
+    if bulk:
+        load_bulk(storage, db, table, vus, idents, witnesses)
+    elif workers > 1:
+        allocate_idents(cur, table, vus, idents)
+        load_parallel(storage, table, vus, idents, witnesses, batch_size, workers)
+    else:
+        done = []
+
+        def progress(wit):
+            done.append(wit)
+            sys.stdout.write("\r{} / {}: {}     ".format(len(done), len(witnesses), wit))
+            sys.stdout.flush()
+
+        load_witnesses(db, cur, table, vus, idents, witnesses, batch_size, progress)
+
+    if compact:
+        print("\nCompacting {}_ed_map".format(table))
+        compact_map(storage, db, table, text_ident=False)
+
+    # Phase 3: indexes (quicker to build after the bulk load than maintain during it)
+    print("\nCreating indexes")
+    create_map_indexes(storage, db, table, text_ident=False)
 
 
 def main():
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('-u', '--mysql-user', required=True, help='User to connect to mysql with')
-    parser.add_argument('-p', '--mysql-password', required=True, help='Password to connect to mysql with')
-    parser.add_argument('-s', '--mysql-host', required=True, help='Host to connect to')
-    parser.add_argument('-d', '--mysql-db', required=True, help='Database to connect to')
+    add_storage_arguments(parser)
     parser.add_argument('-t', '--table', required=True, help='Table name to get data from')
+    parser.add_argument('--batch-size', default=DEFAULT_BATCH_SIZE, type=int,
+                        help='Number of rows to insert per batch (default {})'.format(DEFAULT_BATCH_SIZE))
+    parser.add_argument('--workers', default=1, type=int,
+                        help='Number of worker processes to load witnesses with (default 1)')
+    parser.add_argument('--incremental', '--resume', default=False, action='store_true',
+                        help='Keep the existing tables and only load witnesses that are new or '
+                             'have changed (or weren\'t finished last time)')
+    parser.add_argument('--compact', default=False, action='store_true',
+                        help='Store the readings in the compact integer-keyed schema, with '
+                             '{table}_ed_map as a view onto it (not for use with --incremental)')
+    parser.add_argument('--bulk', default=False, action='store_true',
+                        help='Write the rows to temporary files and load them with LOAD DATA '
+                             'LOCAL INFILE, reporting the throughput of each phase')
     args = parser.parse_args()
-
-    load_all(args.mysql_host,
-             args.mysql_db,
-             args.mysql_user,
-             args.mysql_password,
-             args.table)
+    storage = get_storage(parser, args)
+    if storage.name != 'mysql' and args.workers > 1:
+        parser.error("--workers needs mysql")
+
+    if args.bulk and args.workers > 1:
+        parser.error("--bulk can't be used with --workers")
+    if args.compact and args.incremental:
+        parser.error("--compact can't be used with --incremental")
+
+    load_all(storage,
+             args.table,
+             args.workers,
+             args.incremental,
+             args.compact,
+             args.bulk,
+             args.batch_size)
 
 
 if __name__ == "__main__":
@@ -2,23 +2,44 @@
 #!/usr/bin/python
 
 import sys
-import MySQLdb
+import multiprocessing
 
+from munster_storage import (add_storage_arguments, get_storage, create_map_indexes,
+                             create_vus_index, drop_map_tables, is_compact, compact_map)
+from munster_dialects import VU_COLUMNS, get_dialect
+from munster_bulk import BulkFile, PhaseStats, extract_vus
 
-def load_witness(witness, cur, table, dialect):
+DEFAULT_BATCH_SIZE = 10000
+
+
+def vu_key(values):
+    """
+    Normalise a sequence of variant unit column values into a hashable key
+    matching the INT columns of the {table}_ed_vus table.
+    """
+    return tuple(None if x is None else int(x) for x in values)
+
+
+def load_vus(cur, table):
+    """
+    Load the whole {table}_ed_vus table into a dict keyed on the VU columns
+    """
+    cur.execute("SELECT id, {} FROM {}_ed_vus".format(', '.join(VU_COLUMNS), table))
+    return {vu_key(row[1:]): row[0] for row in cur.fetchall()}
+
+
+def load_witness(witness, cur, table, dialect, vus):
     """
-    Load a particular witness from the db
+    Load a particular witness from the db, returning the rows to insert into
+    the {table}_ed_map table.
     """
     cur.execute("SELECT * FROM {table} WHERE {HSNR} = %s".format(**dialect), (witness, ))
     reverse = {v: k for k, v in list(dialect.items())}
     field_names = [reverse.get(i[0]) for i in cur.description]
-    attestations = []
-    while True:
-        row = cur.fetchone()
-        if row is None:
-            break
-        attestations.append(row)
+    attestations = cur.fetchall()
 
+    ga = get_ga(witness)
+    map_rows = []
     for row in attestations:
         obj = {field_names[i]: val for i, val in enumerate(row)
                if field_names[i]}
@@ -26,21 +47,133 @@ def load_witness(witness, cur, table, dialect):
         greek = obj['LESART'] if 'LESART' in obj else 'unavailable'
         ident = obj['VARID2']  # assumption is that this is ECM2's variant id
 
-        # Find ident or make a nWEND one
-        cur.execute("""SELECT id FROM {}_ed_vus WHERE BOOK=%s AND CHBEG=%s
-                        AND CHEND=%s AND VBEG=%s AND VEND=%s AND WBEG=%s
-                        AND WEND=%s""".format(table),
-                    (obj['BOOK'], obj['CHBEG'], obj['CHEND'], obj['VBEG'],
-                     obj['VEND'], obj['WBEG'], obj['WEND']))
-        for row in cur.fetchall():
-            vu_id = row[0]
-            break
-        else:
+        try:
+            vu_id = vus[vu_key(obj[x] for x in VU_COLUMNS)]
+        except KeyError:
             raise ValueError("Can't find vu")
 
-        cur.execute("""INSERT INTO {}_ed_map (witness, vu_id, greek, ident)
-                        VALUES (%s, %s, %s, %s);""".format(table),
-                    (get_ga(witness), vu_id, greek, ident))
+        map_rows.append((ga, vu_id, greek, ident))
+
+    return map_rows
+
+
+def save_witnesses(cur, table, map_rows, checksums, batch_size):
+    """
+    Insert map_rows into {table}_ed_map (batch_size rows at a time) for the
+    witnesses in checksums, and record the witnesses' checksums in the
+    {table}_ed_state table. Any old rows for the witnesses must have been
+    removed already (see witnesses_to_load).
+    """
+    query = """INSERT INTO {}_ed_map (witness, vu_id, greek, ident)
+               VALUES (%s, %s, %s, %s);""".format(table)
+    for i in range(0, len(map_rows), batch_size):
+        cur.executemany(query, map_rows[i:i + batch_size])
+    cur.executemany("REPLACE INTO {}_ed_state (witness, checksum) VALUES (%s, %s)".format(table),
+                    [(str(wit), checksum) for wit, checksum in checksums.items()])
+
+
+def load_witnesses(db, cur, table, dialect, vus, witnesses, batch_size, progress):
+    """
+    Load the given witnesses ({witness: checksum}), committing every
+    batch_size rows. The progress function is called with each witness once
+    its readings have been read.
+    """
+    pending = []
+    pending_checksums = {}
+    for wit, checksum in witnesses.items():
+        try:
+            pending.extend(load_witness(wit, cur, table, dialect, vus))
+        except Exception as e:
+            print(e)
+            print()
+            raise
+        pending_checksums[wit] = checksum
+        progress(wit)
+
+        if len(pending) >= batch_size:
+            save_witnesses(cur, table, pending, pending_checksums, batch_size)
+            db.commit()
+            pending = []
+            pending_checksums = {}
+
+    save_witnesses(cur, table, pending, pending_checksums, batch_size)
+    db.commit()
+
+
+# Per-process state for the worker pool
+_worker = {}
+
+
+def _init_worker(storage, table, dialect, counter):
+    """
+    Give each worker process its own connection and copy of the VUs
+    """
+    db = storage.connect()
+    cur = db.cursor()
+    _worker.update(db=db, cur=cur, table=table, dialect=dialect,
+                   vus=load_vus(cur, table), counter=counter)
+
+
+def _count_witness(wit):
+    with _worker['counter'].get_lock():
+        _worker['counter'].value += 1
+
+
+def _load_chunk(args):
+    witnesses, batch_size = args
+    load_witnesses(_worker['db'], _worker['cur'], _worker['table'], _worker['dialect'],
+                   _worker['vus'], witnesses, batch_size, _count_witness)
+
+
+def load_parallel(storage, table, dialect, witnesses, batch_size, workers):
+    """
+    Spread the witnesses across a pool of worker processes, each with its own
+    connection to the db.
+    """
+    items = sorted(witnesses.items())
+    # Several chunks per worker, so the pool stays busy to the end
+    size = max(1, len(items) // (workers * 4))
+    chunks = [(dict(items[i:i + size]), batch_size) for i in range(0, len(items), size)]
+
+    counter = multiprocessing.Value('i', 0)
+    pool = multiprocessing.Pool(workers, _init_worker,
+                                (storage, table, dialect, counter))
+    try:
+        result = pool.map_async(_load_chunk, chunks)
+        while not result.ready():
+            result.wait(1)
+            sys.stdout.write("\r{} / {}     ".format(counter.value, len(witnesses)))
+            sys.stdout.flush()
+        result.get()
+    finally:
+        pool.close()
+        pool.join()
+
+
+def load_bulk(storage, db, table, dialect, vus, witnesses):
+    """
+    Write the readings of the given witnesses ({witness: checksum}) to a
+    temporary file, then load it in one go with storage.load_file.
+    """
+    cur = db.cursor()
+    stats = PhaseStats("Map generation")
+    with BulkFile() as out:
+        for i, wit in enumerate(witnesses):
+            for row in load_witness(wit, cur, table, dialect, vus):
+                out.write(row)
+            sys.stdout.write("\r{} / {}: {}     ".format(i + 1, len(witnesses), wit))
+            sys.stdout.flush()
+        out.close()
+        print()
+        stats.finish(out.rows, out.bytes)
+
+        stats = PhaseStats("Load")
+        storage.load_file(cur, out.name, "{}_ed_map".format(table),
+                          ["witness", "vu_id", "greek", "ident"])
+        cur.executemany("REPLACE INTO {}_ed_state (witness, checksum) VALUES (%s, %s)".format(table),
+                        [(str(wit), checksum) for wit, checksum in witnesses.items()])
+        db.commit()
+        stats.finish(out.rows, out.bytes)
 
 
 def get_ga(wit):
@@ -69,127 +202,263 @@ def get_ga(wit):
     return ret
 
 
-def get_dialect(db, table):
+def get_ga_sql(column):
     """
-    Look at the database table and return something that translates
-    the columns into a standard set.
+    Return a SQL expression equivalent to get_ga for the given column. This
+    evaluates to NULL for witness ids that get_ga can't handle.
     """
-    cur = db.cursor()
-    cur.execute("SELECT * FROM {}".format(table))
-    field_names = [i[0] for i in cur.description]
-
-    default = ("BOOK", "CHBEG", "CHEND", "VBEG", "VEND", "WBEG", "WEND", "VARID2", 'HSNR', 'LESART')
-
-    dialects = [("BOOK", "CHBEG", "CHEND", "VBEG", "VEND", "WBEG", "WEND", "VARID2", 'MSNR', None),
-                ("BUCH", "KAPANF", "KAPEND", "VERSANF", "VERSEND", "WORTANF", "WORTEND", "LABEZ", "HSNR", None),
-                ("BUCH", "KAPANF", "KAPEND", "VERSANF", "VERSEND", "WORTANF", "WORTEND", "VARID2", "HSNR", 'LESART'),
-                ("BUCH", "CHBEG", "CHEND", "VBEG", "VEND", "WBEG", "WEND", "VARID2", "HSNR", None),
-                ("BUCH", "CHBEG", "CHEND", "VBEG", "VEND", "WBEG", "WEND", "VARID2", "HSNR", 'LESART'),
-                ]
-
-    class NoMatch(Exception):
-        pass
+    num = "CAST({} AS UNSIGNED)".format(column)
+    digits = "CAST(SUBSTRING({num}, 2, CHAR_LENGTH({num}) - 2) AS UNSIGNED)".format(num=num)
+    return """CONCAT(CASE
+                  WHEN {num} > 100000 AND {num} < 200000 THEN CONCAT('P', {digits})
+                  WHEN {num} > 200000 AND {num} < 300000 THEN CONCAT('0', {digits})
+                  WHEN {num} > 300000 AND {num} < 400000 THEN CONCAT('', {digits})
+                  WHEN {num} > 400000 AND {num} < 500000 THEN CONCAT('L', {digits})
+                  WHEN {num} = 1 THEN 'A'
+              END,
+              IF(MOD({num}, 10) = 1, 'S', ''))""".format(num=num, digits=digits)
+
+
+def load_set_based(cur, table, dialect, witnesses, incremental=False):
+    """
+    Load the readings into {table}_ed_map with a single INSERT ... SELECT,
+    leaving MySQL to do the VU lookups and GA conversion. If incremental is
+    True then only the witnesses ({witness: checksum}) supplied are
+    replaced - otherwise everything is loaded.
+    """
+    d = dict(dialect)
+    d['where'] = ''
+    params = []
+    if incremental:
+        if not witnesses:
+            return
+        d['where'] = "WHERE s.{} IN ({})".format(dialect['HSNR'], ', '.join(['%s'] * len(witnesses)))
+        params = list(witnesses)
+
+    d['ga'] = get_ga_sql("s.{}".format(dialect['HSNR']))
+    d['greek'] = "s.{}".format(dialect['LESART']) if dialect['LESART'] else "'unavailable'"
+    d['join'] = " AND ".join("v.{0} <=> s.{1}".format(x, dialect[x]) for x in VU_COLUMNS)
+
+    # get_ga raises for witnesses it can't handle - so check for those first
+    cur.execute("SELECT DISTINCT s.{HSNR} FROM {table} s WHERE {ga} IS NULL".format(**d))
+    bad = [row[0] for row in cur.fetchall()]
+    if bad:
+        raise ValueError("Can't handle {}".format(', '.join(str(x) for x in bad)))
+
+    cur.execute("""INSERT INTO {table}_ed_map (witness, vu_id, greek, ident)
+                       SELECT {ga}, v.id, {greek}, s.{VARID2}
+                       FROM {table} s
+                       INNER JOIN {table}_ed_vus v
+                       ON {join}
+                       {where};""".format(**d), params or None)
+    print("Loaded {} readings".format(cur.rowcount))
+    cur.executemany("REPLACE INTO {}_ed_state (witness, checksum) VALUES (%s, %s)".format(table),
+                    [(str(wit), checksum) for wit, checksum in witnesses.items()])
+
+
+def source_checksums(cur, dialect):
+    """
+    Return {witness: checksum} for the witnesses in the source table, where
+    the checksum (computed inside MySQL) changes if any of the witness's
+    rows do.
+    """
+    cols = [dialect[x] for x in VU_COLUMNS + ('VARID2', 'LESART') if dialect[x]]
+    cur.execute("""SELECT {HSNR}, COUNT(*), BIT_XOR(CRC32(CONCAT_WS('|', {cols})))
+                   FROM {table}
+                   GROUP BY {HSNR};""".format(cols=', '.join(cols), **dialect))
+    return {row[0]: "{}:{}".format(row[1], row[2]) for row in cur.fetchall()}
 
-    match = None
-    for dialect in dialects:
-        try:
-            for x in dialect:
-                if x is not None and x not in field_names:
-                    raise NoMatch
-        except NoMatch:
-            continue
-        else:
-            match = dialect
-            break
 
-    if not match:
-        raise NoMatch("Can't identify dialect")
+def witnesses_to_load(cur, table, checksums):
+    """
+    Compare the source checksums with the {table}_ed_state table, removing
+    any witnesses that have gone from the source, and the old rows of those
+    that have changed. Return the ones that are new or changed.
+    """
+    cur.execute("SELECT witness, checksum FROM {}_ed_state".format(table))
+    loaded = dict(cur.fetchall())
+
+    current = set(str(wit) for wit in checksums)
+    removed = [wit for wit in loaded if wit not in current]
+    if removed:
+        print("Removing {} witness(es) no longer in the source table".format(len(removed)))
+        cur.executemany("DELETE FROM {}_ed_map WHERE witness = %s".format(table),
+                        [(get_ga(wit), ) for wit in removed])
+        cur.executemany("DELETE FROM {}_ed_state WHERE witness = %s".format(table),
+                        [(wit, ) for wit in removed])
+
+    todo = {wit: checksum for wit, checksum in checksums.items()
+            if loaded.get(str(wit)) != checksum}
+    # Only witnesses in {table}_ed_state have rows to replace
+    changed = [wit for wit in todo if str(wit) in loaded]
+    if changed:
+        cur.executemany("DELETE FROM {}_ed_map WHERE witness = %s".format(table),
+                        [(get_ga(wit), ) for wit in changed])
+        cur.executemany("DELETE FROM {}_ed_state WHERE witness = %s".format(table),
+                        [(str(wit), ) for wit in changed])
+    print("{} of {} witnesses are new or changed".format(len(todo), len(checksums)))
+    return todo
+
+
+def load_all(storage, table, batch_size=DEFAULT_BATCH_SIZE, set_based=False,
+             workers=1, incremental=False, compact=False, bulk=False):
+    """
+    Connect to the db and loop through what we find
 
-    print("Dialect {} detected".format(dialects.index(match)))
+    If set_based is True then the readings are loaded by a single query run
+    inside MySQL rather than witness by witness. Otherwise the witnesses are
+    spread across the specified number of worker processes.
 
-    return {default[i]: match[i] for i in range(len(default))}
+    If incremental is True then the existing tables are kept, and only
+    witnesses that are new or have changed since they were last loaded
+    (according to the {table}_ed_state table) are loaded.
 
+    If compact is True then {table}_ed_map is converted to the compact
+    schema once it's loaded (see munster_storage.compact_map).
 
-def load_all(host, db, user, password, table):
+    If bulk is True then the variant units and readings are written to
+    temporary files and loaded with LOAD DATA LOCAL INFILE, reporting the
+    throughput of each phase.
     """
-    Connect to the mysql db and loop through what we find
-    """
-    db = MySQLdb.connect(host=host, user=user, passwd=password, db=db, charset='utf8')
+    db = storage.connect(local_infile=bulk)
     cur = db.cursor()
 
-    cur.execute("DROP TABLE IF EXISTS ed_map;")
-    cur.execute("DROP TABLE IF EXISTS ed_vus;")
-    cur.execute("DROP TABLE IF EXISTS {}_ed_map;".format(table))
-    cur.execute("DROP TABLE IF EXISTS {}_ed_vus;".format(table))
+    if not incremental:
+        cur.execute("DROP TABLE IF EXISTS ed_map;")
+        cur.execute("DROP TABLE IF EXISTS ed_vus;")
+        drop_map_tables(storage, db, table)
+    elif is_compact(storage, db, table):
+        raise ValueError("{}_ed_map is compact - it can't be loaded incrementally".format(table))
 
     # Phase 1: load variant units
-    cur.execute("""CREATE TABLE {}_ed_vus (
-                        id INT AUTO_INCREMENT KEY,
+    cur.execute("""CREATE TABLE IF NOT EXISTS {}_ed_vus (
+                        id {},
                         BOOK INT,
                         CHBEG INT,
                         CHEND INT,
                         VBEG INT,
                         VEND INT,
                         WBEG INT,
-                        WEND INT);""".format(table))
+                        WEND INT);""".format(table, storage.autoincrement_key))
 
     forward_dialect = get_dialect(db, table)
 
     d = {'table': table}
     d.update(forward_dialect)
-    cur.execute("""INSERT INTO {table}_ed_vus (BOOK, CHBEG, CHEND, VBEG, VEND, WBEG, WEND)
+    if bulk:
+        vus = load_vus(cur, table)
+        extract_vus(storage, db, table, [d[x] for x in VU_COLUMNS], VU_COLUMNS, vus, vu_key)
+    else:
+        # Only add VUs we don't already have (for incremental loads)
+        cur.execute("""INSERT INTO {table}_ed_vus (BOOK, CHBEG, CHEND, VBEG, VEND, WBEG, WEND)
                        SELECT {BOOK}, {CHBEG}, {CHEND}, {VBEG}, {VEND}, {WBEG}, {WEND}
-                       FROM {table}
+                       FROM {table} s
+                       WHERE NOT EXISTS (
+                           SELECT 1 FROM {table}_ed_vus v
+                           WHERE v.BOOK {eq} s.{BOOK} AND v.CHBEG {eq} s.{CHBEG}
+                           AND v.CHEND {eq} s.{CHEND} AND v.VBEG {eq} s.{VBEG}
+                           AND v.VEND {eq} s.{VEND} AND v.WBEG {eq} s.{WBEG}
+                           AND v.WEND {eq} s.{WEND})
                        GROUP BY {BOOK}, {CHBEG}, {CHEND}, {VBEG}, {VEND}, {WBEG}, {WEND};"""
-                .format(**d))
+                .format(eq=storage.null_safe_eq, **d))
 
-    cur.execute("""CREATE TABLE {}_ed_map (
+    cur.execute("""CREATE TABLE IF NOT EXISTS {}_ed_map (
                     witness TEXT NOT NULL,
                     vu_id INT NOT NULL,
-                    greek TEXT CHARACTER SET UTF8,
+                    greek {},
                     ident TEXT NOT NULL,
 
                     FOREIGN KEY (vu_id)
                         REFERENCES {}_ed_vus(id)
-                    );""".format(table, table))
+                    );""".format(table, storage.utf8_text, table))
+
+    # Which witnesses have been loaded, and from what source data
+    cur.execute("""CREATE TABLE IF NOT EXISTS {}_ed_state (
+                    witness VARCHAR(32) NOT NULL PRIMARY KEY,
+                    checksum VARCHAR(64) NOT NULL
+                    );""".format(table))
+    db.commit()
+
+    # The readings are matched to their VUs in phase 2 (by a join, for
+    # set_based), so index the VUs now rather than in phase 3
+    create_vus_index(storage, db, table)
 
     # Phase 2: load readings
-    cur.execute("SELECT DISTINCT {HSNR} FROM {table};".format(**d))
+    witnesses = source_checksums(cur, d)
+    if incremental:
+        witnesses = witnesses_to_load(cur, table, witnesses)
+        db.commit()
+
+    if bulk:
+        print()
+        load_bulk(storage, db, table, d, vus, witnesses)
+    elif set_based:
+        load_set_based(cur, table, d, witnesses, incremental)
+        db.commit()
+    elif workers > 1:
+        print()
+        load_parallel(storage, table, d, witnesses, batch_size, workers)
+    else:
+        print()
+        vus = load_vus(cur, table)
+        done = []
 
-    witnesses = set()
-    for row in cur.fetchall():
-        witnesses.add(row[0])
+        def progress(wit):
+            done.append(wit)
+            sys.stdout.write("\r{} / {}: {}     ".format(len(done), len(witnesses), wit))
+            sys.stdout.flush()
 
-    print()
-    for i, wit in enumerate(witnesses):
-        sys.stdout.write("\r{} / {}: {}     ".format(i + 1, len(witnesses), wit))
-        sys.stdout.flush()
-        try:
-            load_witness(wit, cur, table, d)
-        except Exception as e:
-            print(e)
-            print()
-            raise
-        else:
-            db.commit()
+        load_witnesses(db, cur, table, d, vus, witnesses, batch_size, progress)
+
+    if compact:
+        print("\nCompacting {}_ed_map".format(table))
+        compact_map(storage, db, table)
+
+    # Phase 3: indexes (quicker to build after the bulk load than maintain during it)
+    print("\nCreating indexes")
+    create_map_indexes(storage, db, table)
 
 
 def main():
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('-u', '--mysql-user', required=True, help='User to connect to mysql with')
-    parser.add_argument('-p', '--mysql-password', required=True, help='Password to connect to mysql with')
-    parser.add_argument('-s', '--mysql-host', required=True, help='Host to connect to')
-    parser.add_argument('-d', '--mysql-db', required=True, help='Database to connect to')
+    add_storage_arguments(parser)
     parser.add_argument('-t', '--table', required=True, help='Table name to get data from')
+    parser.add_argument('--batch-size', default=DEFAULT_BATCH_SIZE, type=int,
+                        help='Number of rows to insert per batch (default {})'.format(DEFAULT_BATCH_SIZE))
+    parser.add_argument('--set-based', default=False, action='store_true',
+                        help='Load the readings with a single INSERT ... SELECT inside MySQL, '
+                             'rather than witness by witness')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='Number of worker processes to load witnesses with (default 1)')
+    parser.add_argument('--incremental', '--resume', default=False, action='store_true',
+                        help='Keep the existing tables and only load witnesses that are new or '
+                             'have changed (or weren\'t finished last time)')
+    parser.add_argument('--compact', default=False, action='store_true',
+                        help='Store the readings in the compact integer-keyed schema, with '
+                             '{table}_ed_map as a view onto it (not for use with --incremental)')
+    parser.add_argument('--bulk', default=False, action='store_true',
+                        help='Write the rows to temporary files and load them with LOAD DATA '
+                             'LOCAL INFILE, reporting the throughput of each phase')
 
     args = parser.parse_args()
-
-    load_all(args.mysql_host,
-             args.mysql_db,
-             args.mysql_user,
-             args.mysql_password,
-             args.table)
+    storage = get_storage(parser, args)
+    if storage.name != 'mysql' and (args.set_based or args.workers > 1):
+        parser.error("--set-based and --workers need mysql")
+
+    if args.bulk and (args.set_based or args.workers > 1):
+        parser.error("--bulk can't be used with --set-based or --workers")
+    if args.compact and args.incremental:
+        parser.error("--compact can't be used with --incremental")
+
+    load_all(storage,
+             args.table,
+             args.batch_size,
+             args.set_based,
+             args.workers,
+             args.incremental,
+             args.compact,
+             args.bulk)
     print()
 
 if __name__ == "__main__":
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk loading for the Muenster importers: rows are streamed to temporary
+tab separated files (in the format LOAD DATA INFILE reads by default) and
+loaded in one go with the storage's load_file, timing each phase.
+"""
+
+import os
+import re
+import tempfile
+import time
+
+NULL = '\\N'
+_escapes = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+_unescapes = {'t': '\t', 'n': '\n', 'r': '\r'}
+_escaped = re.compile(r'\\(.)')
+
+
+def tsv_line(row):
+    """
+    Return a row as a line of a LOAD DATA INFILE file
+    """
+    return '\t'.join(NULL if x is None else str(x).translate(_escapes) for x in row) + '\n'
+
+
+def tsv_split(line):
+    """
+    The inverse of tsv_line
+    """
+    return [None if x == NULL else _escaped.sub(lambda m: _unescapes.get(m.group(1), m.group(1)), x)
+            for x in line.rstrip('\n').split('\t')]
+
+
+class BulkFile(object):
+    """
+    A temporary file of rows to load, removed again on leaving the with block
+    """
+    def __init__(self):
+        fd, self.name = tempfile.mkstemp(suffix='.tsv')
+        self.fh = os.fdopen(fd, 'w', encoding='utf8', newline='')
+        self.rows = 0
+
+    def write(self, row):
+        self.fh.write(tsv_line(row))
+        self.rows += 1
+
+    def close(self):
+        """
+        Finish writing, ready for loading
+        """
+        if not self.fh.closed:
+            self.fh.close()
+
+    @property
+    def bytes(self):
+        return self.fh.tell() if not self.fh.closed else os.path.getsize(self.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        os.remove(self.name)
+
+
+class PhaseStats(object):
+    """
+    Time a phase of an import, and report its throughput
+    """
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.bytes = 0
+        self.start = time.time()
+        self.elapsed = None
+
+    def finish(self, rows, nbytes):
+        self.elapsed = time.time() - self.start
+        self.rows = rows
+        self.bytes = nbytes
+        print(self)
+
+    def __str__(self):
+        secs = max(self.elapsed or 0, 1e-6)
+        return ("{}: {} rows, {} bytes in {:.2f}s ({:.0f} rows/sec, {:.0f} bytes/sec)"
+                .format(self.name, self.rows, self.bytes, secs, self.rows / secs, self.bytes / secs))
+
+
+def extract_vus(storage, db, table, source_columns, columns, vus, key=tuple):
+    """
+    Add the variant units of the source table (identified by its
+    source_columns) that aren't already in vus ({key: id}) to vus and to the
+    {table}_ed_vus table (whose VU columns are columns). key turns the
+    source values into a vus key.
+    """
+    stats = PhaseStats("VU extraction")
+    next_id = max(vus.values(), default=0) + 1
+    with BulkFile() as out:
+        cur = storage.streaming_cursor(db)
+        cur.execute("SELECT DISTINCT {} FROM {}".format(', '.join(source_columns), table))
+        for row in cur:
+            vu = key(row)
+            if vu not in vus:
+                vus[vu] = next_id
+                out.write((next_id, ) + tuple(vu))
+                next_id += 1
+        cur.close()
+        out.close()
+        storage.load_file(db.cursor(), out.name, "{}_ed_vus".format(table), ['id'] + list(columns))
+        db.commit()
+        stats.finish(out.rows, out.bytes)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of the column names used by the various Muenster databases, and by
+the {table}_ed_vus tables the importers create from them.
+
+Detected dialects are cached per table, and detection only ever asks the db
+for column names - it never reads any rows.
+"""
+
+# The standard column names we translate each source table into
+DEFAULT = ("BOOK", "CHBEG", "CHEND", "VBEG", "VEND", "WBEG", "WEND", "VARID2", 'HSNR', 'LESART')
+
+# Source table dialects, in the same order as DEFAULT (None means not present)
+DIALECTS = [("BOOK", "CHBEG", "CHEND", "VBEG", "VEND", "WBEG", "WEND", "VARID2", 'MSNR', None),
+            ("BUCH", "KAPANF", "KAPEND", "VERSANF", "VERSEND", "WORTANF", "WORTEND", "LABEZ", "HSNR", None),
+            ("BUCH", "KAPANF", "KAPEND", "VERSANF", "VERSEND", "WORTANF", "WORTEND", "VARID2", "HSNR", 'LESART'),
+            ("BUCH", "CHBEG", "CHEND", "VBEG", "VEND", "WBEG", "WEND", "VARID2", "HSNR", None),
+            ("BUCH", "CHBEG", "CHEND", "VBEG", "VEND", "WBEG", "WEND", "VARID2", "HSNR", 'LESART'),
+            ]
+
+# The variant unit columns of the {table}_ed_vus tables made by
+# import_from_munster_mysql.py and import_from_munster_jn18_mysql.py
+VU_COLUMNS = ("BOOK", "CHBEG", "CHEND", "VBEG", "VEND", "WBEG", "WEND")
+JN18_VU_COLUMNS = ("BV", "EV", "BW", "EW")
+
+# How each flavour of {table}_ed_vus table names the standard VU columns
+VUS_DIALECTS = [dict(zip(VU_COLUMNS, VU_COLUMNS)),
+                {"BOOK": None, "CHBEG": None, "CHEND": None,
+                 "VBEG": "BV", "VEND": "EV", "WBEG": "BW", "WEND": "EW"},
+                ]
+
+
+class NoMatch(Exception):
+    pass
+
+
+_dialect_cache = {}
+_vus_dialect_cache = {}
+
+
+def get_columns(db, table):
+    """
+    Return the column names of a table, without fetching any rows
+    """
+    cur = db.cursor()
+    cur.execute("SELECT * FROM {} LIMIT 0".format(table))
+    cur.fetchall()
+    return [i[0] for i in cur.description]
+
+
+def get_dialect(db, table):
+    """
+    Look at the database table and return something that translates
+    the columns into a standard set.
+    """
+    if table in _dialect_cache:
+        return _dialect_cache[table]
+
+    field_names = get_columns(db, table)
+
+    for i, dialect in enumerate(DIALECTS):
+        if all(x is None or x in field_names for x in dialect):
+            break
+    else:
+        raise NoMatch("Can't identify dialect")
+
+    print("Dialect {} detected".format(i))
+
+    _dialect_cache[table] = {DEFAULT[i]: dialect[i] for i in range(len(DEFAULT))}
+    return _dialect_cache[table]
+
+
+def get_vus_dialect(db, table):
+    """
+    Look at the {table}_ed_vus table and return a dict translating the
+    standard VU column names into its own (or None where it doesn't have one).
+    """
+    if table in _vus_dialect_cache:
+        return _vus_dialect_cache[table]
+
+    field_names = [x.upper() for x in get_columns(db, "{}_ed_vus".format(table))]
+
+    for dialect in VUS_DIALECTS:
+        if all(x is None or x in field_names for x in dialect.values()):
+            break
+    else:
+        raise NoMatch("Can't identify columns of {}_ed_vus".format(table))
+
+    _vus_dialect_cache[table] = dialect
+    return dialect
+
+
+def get_vu_refs(db, table):
+    """
+    Return {vu_id: reference} for all the variant units in {table}_ed_vus,
+    with references like 18/2-4 or 18/20-19/4 (verse/word-[verse/]word).
+    """
+    cur = db.cursor()
+    cur.execute("SELECT id, {VBEG}, {VEND}, {WBEG}, {WEND} FROM {table}_ed_vus"
+                .format(table=table, **get_vus_dialect(db, table)))
+    vu_mapping = {}
+    for row in cur.fetchall():
+        i, bv, ev, bw, ew = row
+        ref = "{}/".format(bv)
+        if bv == ev:
+            if bw == ew:
+                ref += str(bw)
+            else:
+                ref += "{}-{}".format(bw, ew)
+        else:
+            ref += "{}-{}/{}".format(bw, ev, ew)
+        vu_mapping[i] = ref
+    return vu_mapping
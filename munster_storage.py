@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+"""
+Storage backends for the Muenster scripts. The scripts write their SQL for
+MySQL (with %s placeholders); the SQLite backend lets them run against a
+local .sqlite file instead (see munster_to_sqlite.py).
+"""
+
+import hashlib
+import sqlite3
+import zlib
+
+from munster_dialects import get_vus_dialect
+
+
+class MySQLStorage(object):
+    """
+    A MySQL database, accessed with MySQLdb
+    """
+    name = 'mysql'
+    autoincrement_key = "INT AUTO_INCREMENT KEY"
+    utf8_text = "TEXT CHARACTER SET UTF8"
+    null_safe_eq = "<=>"
+
+    def __init__(self, host, db, user, password, require_indexes=False):
+        self.host = host
+        self.db = db
+        self.user = user
+        self.password = password
+        self.require_indexes = require_indexes
+
+    def __str__(self):
+        return self.db
+
+    def connect(self, local_infile=False, **kwargs):
+        """
+        Connect to the db. Set local_infile to allow load_file.
+        """
+        import MySQLdb
+        if local_infile:
+            kwargs['local_infile'] = 1
+        return MySQLdb.connect(host=self.host, user=self.user, passwd=self.password,
+                               db=self.db, charset='utf8', **kwargs)
+
+    def streaming_cursor(self, db):
+        """
+        Return a cursor that streams results rather than reading them all
+        into memory first
+        """
+        import MySQLdb.cursors
+        return db.cursor(MySQLdb.cursors.SSCursor)
+
+    def create_index(self, cur, name, table, columns):
+        """
+        Create an index, unless it exists already. Columns may include
+        a prefix length - e.g. "witness(10)".
+        """
+        import MySQLdb
+        try:
+            cur.execute("CREATE INDEX {} ON {} ({})".format(name, table, ', '.join(columns)))
+        except MySQLdb.OperationalError as e:
+            if "Duplicate key" not in str(e):
+                raise
+
+    def load_file(self, cur, filename, table, columns):
+        """
+        Load a file written by munster_bulk.BulkFile into the given columns
+        of a table, with LOAD DATA LOCAL INFILE (so the connection must have
+        been made with local_infile=True).
+        """
+        cur.execute("""LOAD DATA LOCAL INFILE %s INTO TABLE {}
+                       CHARACTER SET utf8 ({})""".format(table, ', '.join(columns)), (filename, ))
+
+    def table_checksum(self, cur, table):
+        """
+        Return a value that changes whenever the table's contents do
+        """
+        cur.execute("CHECKSUM TABLE {}".format(table))
+        return cur.fetchone()[1]
+
+    def table_exists(self, cur, table):
+        cur.execute("SHOW TABLES LIKE %s", (table, ))
+        return bool(cur.fetchall())
+
+    def index_columns(self, cur, table):
+        """
+        Return a list of the indexes on a table, each as a list of columns
+        """
+        cur.execute("SHOW INDEX FROM {}".format(table))
+        indexes = {}
+        for row in cur.fetchall():
+            indexes.setdefault(row[2], []).append((row[3], row[4]))
+        return [[col for _, col in sorted(x)] for x in indexes.values()]
+
+
+class _SQLiteCursor(sqlite3.Cursor):
+    """
+    Cursor accepting MySQLdb style %s placeholders
+    """
+    def execute(self, query, params=()):
+        return super().execute(query.replace('%s', '?'), params or ())
+
+    def executemany(self, query, seq_of_params):
+        return super().executemany(query.replace('%s', '?'), seq_of_params)
+
+
+class _SQLiteConnection(sqlite3.Connection):
+    def cursor(self, factory=_SQLiteCursor):
+        return super().cursor(factory)
+
+
+class _BitXor(object):
+    def __init__(self):
+        self.value = 0
+
+    def step(self, value):
+        if value is not None:
+            self.value ^= value
+
+    def finalize(self):
+        return self.value
+
+
+def _concat_ws(sep, *args):
+    return sep.join(str(x) for x in args if x is not None)
+
+
+def _crc32(value):
+    if value is None:
+        return None
+    return zlib.crc32(str(value).encode('utf8'))
+
+
+class SQLiteStorage(object):
+    """
+    A single SQLite file
+    """
+    name = 'sqlite'
+    autoincrement_key = "INTEGER PRIMARY KEY AUTOINCREMENT"
+    utf8_text = "TEXT"
+    null_safe_eq = "IS"
+
+    def __init__(self, filename, require_indexes=False):
+        self.filename = filename
+        self.require_indexes = require_indexes
+
+    def __str__(self):
+        return self.filename
+
+    def connect(self, local_infile=False, **kwargs):
+        db = sqlite3.connect(self.filename, factory=_SQLiteConnection, **kwargs)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        # The MySQL functions our SQL uses
+        db.create_function("CRC32", 1, _crc32)
+        db.create_function("CONCAT_WS", -1, _concat_ws)
+        db.create_aggregate("BIT_XOR", 1, _BitXor)
+        return db
+
+    def streaming_cursor(self, db):
+        return db.cursor()
+
+    def create_index(self, cur, name, table, columns):
+        """
+        Create an index, unless it exists already. Any MySQL prefix lengths
+        (e.g. "witness(10)") are ignored.
+        """
+        columns = [x.split('(')[0] for x in columns]
+        cur.execute("CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(name, table, ', '.join(columns)))
+
+    def load_file(self, cur, filename, table, columns):
+        """
+        Load a file written by munster_bulk.BulkFile into the given columns
+        of a table
+        """
+        from munster_bulk import tsv_split
+        query = "INSERT INTO {} ({}) VALUES ({})".format(
+            table, ', '.join(columns), ', '.join(['%s'] * len(columns)))
+        with open(filename, encoding='utf8', newline='') as fh:
+            cur.executemany(query, (tsv_split(line) for line in fh))
+
+    def table_checksum(self, cur, table):
+        """
+        Return a value that changes whenever the table's contents do (the
+        row count and the highest rowid, which grows as rows are reloaded)
+        """
+        cur.execute("SELECT COUNT(*), MAX(rowid) FROM {}".format(table))
+        return "{}:{}".format(*cur.fetchone())
+
+    def table_exists(self, cur, table):
+        cur.execute("SELECT name FROM sqlite_master WHERE name = %s", (table, ))
+        return bool(cur.fetchall())
+
+    def index_columns(self, cur, table):
+        """
+        Return a list of the indexes on a table, each as a list of columns
+        """
+        cur.execute("PRAGMA index_list({})".format(table))
+        names = [row[1] for row in cur.fetchall()]
+        indexes = []
+        for name in names:
+            cur.execute("PRAGMA index_info({})".format(name))
+            indexes.append([row[2] for row in sorted(cur.fetchall())])
+        return indexes
+
+
+class MissingIndexes(Exception):
+    pass
+
+
+def is_compact(storage, db, table):
+    """
+    Is {table}_ed_map a view onto the compact schema (see compact_map)?
+    """
+    return storage.table_exists(db.cursor(), "{}_ed_map_c".format(table))
+
+
+def map_checksum(storage, db, table):
+    """
+    Return a string that changes whenever the data in the {table}_ed_vus and
+    {table}_ed_map tables (or those behind the compact view) does.
+
+    The importers record a checksum of each witness's source data in
+    {table}_ed_state, so if that exists it's used (with the row count and
+    highest id of {table}_ed_vus) rather than reading the whole map. Without
+    it, the storage's table_checksum of each table is used.
+    """
+    cur = db.cursor()
+    state = "{}_ed_state".format(table)
+    if storage.table_exists(cur, state):
+        cur.execute("SELECT COUNT(*), MAX(id) FROM {}_ed_vus".format(table))
+        key = hashlib.sha1("vus:{}:{}".format(*cur.fetchone()).encode('utf8'))
+        cur.execute("SELECT witness, checksum FROM {} ORDER BY witness".format(state))
+        for witness, checksum in cur.fetchall():
+            key.update("|{}:{}".format(witness, checksum).encode('utf8'))
+        return "state:{}".format(key.hexdigest())
+
+    tables = ["vus"]
+    if is_compact(storage, db, table):
+        tables += ["map_c", "readings", "witnesses"]
+    else:
+        tables += ["map"]
+    return '/'.join(str(storage.table_checksum(cur, "{}_ed_{}".format(table, x))) for x in tables)
+
+
+def drop_map_tables(storage, db, table):
+    """
+    Drop the {table}_ed_* tables, in either schema
+    """
+    cur = db.cursor()
+    if is_compact(storage, db, table):
+        cur.execute("DROP VIEW IF EXISTS {}_ed_map;".format(table))
+        cur.execute("DROP TABLE IF EXISTS {}_ed_map_c;".format(table))
+        cur.execute("DROP TABLE IF EXISTS {}_ed_readings;".format(table))
+        cur.execute("DROP TABLE IF EXISTS {}_ed_witnesses;".format(table))
+    cur.execute("DROP TABLE IF EXISTS {}_ed_map;".format(table))
+    cur.execute("DROP TABLE IF EXISTS {}_ed_vus;".format(table))
+    cur.execute("DROP TABLE IF EXISTS {}_ed_state;".format(table))
+
+
+def compact_map(storage, db, table, text_ident=True):
+    """
+    Convert a freshly loaded {table}_ed_map table to the compact schema:
+
+      {table}_ed_witnesses - integer id for each witness
+      {table}_ed_readings  - small integer id for each (ident, greek) of a VU
+      {table}_ed_map_c     - (witness_id, vu_id, reading) for each attestation
+
+    with a {table}_ed_map view joining them back up, so readers still see
+    the original columns. Set text_ident to False if the ident column is an
+    INT rather than TEXT.
+    """
+    cur = db.cursor()
+    cur.execute("ALTER TABLE {0}_ed_map RENAME TO {0}_ed_map_raw;".format(table))
+
+    cur.execute("""CREATE TABLE {}_ed_witnesses (
+                    id {},
+                    witness VARCHAR(64) NOT NULL);""".format(table, storage.autoincrement_key))
+    cur.execute("""INSERT INTO {0}_ed_witnesses (witness)
+                    SELECT DISTINCT witness FROM {0}_ed_map_raw ORDER BY witness;""".format(table))
+    storage.create_index(cur, "{}_witness_name_idx".format(table),
+                         "{}_ed_witnesses".format(table), ["witness"])
+
+    cur.execute("""CREATE TABLE {}_ed_readings (
+                    vu_id INT NOT NULL,
+                    reading SMALLINT NOT NULL,
+                    ident {} NOT NULL,
+                    greek {},
+                    PRIMARY KEY (vu_id, reading));"""
+                .format(table, "TEXT" if text_ident else "INT", storage.utf8_text))
+    cur.execute("""SELECT DISTINCT vu_id, ident, greek FROM {}_ed_map_raw
+                    ORDER BY vu_id;""".format(table))
+    readings = []
+    last_vu = None
+    for vu_id, ident, greek in cur.fetchall():
+        reading = reading + 1 if vu_id == last_vu else 1
+        last_vu = vu_id
+        readings.append((vu_id, reading, ident, greek))
+    cur.executemany("""INSERT INTO {}_ed_readings (vu_id, reading, ident, greek)
+                        VALUES (%s, %s, %s, %s);""".format(table), readings)
+    storage.create_index(cur, "{}_reading_ident_idx".format(table), "{}_ed_readings".format(table),
+                         ["vu_id", "ident(20)" if text_ident else "ident"])
+
+    cur.execute("""CREATE TABLE {}_ed_map_c (
+                    witness_id INT NOT NULL,
+                    vu_id INT NOT NULL,
+                    reading SMALLINT NOT NULL);""".format(table))
+    cur.execute("""INSERT INTO {0}_ed_map_c (witness_id, vu_id, reading)
+                    SELECT w.id, m.vu_id, r.reading
+                    FROM {0}_ed_map_raw m
+                    INNER JOIN {0}_ed_witnesses w ON w.witness = m.witness
+                    INNER JOIN {0}_ed_readings r ON r.vu_id = m.vu_id AND r.ident = m.ident
+                        AND r.greek {1} m.greek;""".format(table, storage.null_safe_eq))
+    print("Compacted {} readings".format(cur.rowcount))
+
+    cur.execute("DROP TABLE {}_ed_map_raw;".format(table))
+    cur.execute("""CREATE VIEW {0}_ed_map AS
+                    SELECT w.witness AS witness, m.vu_id AS vu_id, r.greek AS greek, r.ident AS ident
+                    FROM {0}_ed_map_c m
+                    INNER JOIN {0}_ed_witnesses w ON w.id = m.witness_id
+                    INNER JOIN {0}_ed_readings r ON r.vu_id = m.vu_id AND r.reading = m.reading;"""
+                .format(table))
+    db.commit()
+
+
+def map_indexes(storage, db, table, text_ident=True):
+    """
+    Return the (name, table, columns) of the indexes the Muenster scripts need
+    on the {table}_ed_map (or compact {table}_ed_map_c) and {table}_ed_vus
+    tables, matching the ways they're queried: a witness's readings, the
+    witnesses with a reading, and finding a VU by its location. Set
+    text_ident to False if the ident column is an INT rather than TEXT.
+    """
+    vu_columns = [x for x in get_vus_dialect(db, table).values() if x is not None]
+    if is_compact(storage, db, table):
+        map_table = "{}_ed_map_c".format(table)
+        witness_vu = ["witness_id", "vu_id"]
+        vu_ident = ["vu_id", "reading"]
+    else:
+        map_table = "{}_ed_map".format(table)
+        witness_vu = ["witness(20)", "vu_id"]
+        vu_ident = ["vu_id", "ident(20)" if text_ident else "ident"]
+    return [("{}_witness_vu_idx".format(table), map_table, witness_vu),
+            ("{}_vu_ident_idx".format(table), map_table, vu_ident),
+            ("{}_vu_key_idx".format(table), "{}_ed_vus".format(table), vu_columns)]
+
+
+def create_map_indexes(storage, db, table, text_ident=True):
+    """
+    Create the indexes the Muenster scripts need (see map_indexes)
+    """
+    cur = db.cursor()
+    for name, index_table, columns in map_indexes(storage, db, table, text_ident):
+        storage.create_index(cur, name, index_table, columns)
+    db.commit()
+
+
+def create_vus_index(storage, db, table):
+    """
+    Create just the {table}_ed_vus index (see map_indexes). That table is
+    small, so it's worth indexing before the readings are loaded, for them
+    to be matched to their VUs.
+    """
+    cur = db.cursor()
+    vus_table = "{}_ed_vus".format(table)
+    for name, index_table, columns in map_indexes(storage, db, table):
+        if index_table == vus_table:
+            storage.create_index(cur, name, index_table, columns)
+    db.commit()
+
+
+def check_map_indexes(storage, db, table):
+    """
+    Check the indexes the Muenster scripts need (see map_indexes) exist,
+    printing a warning - or raising MissingIndexes if the storage has
+    require_indexes set - if not.
+    """
+    cur = db.cursor()
+    missing = []
+    for name, index_table, columns in map_indexes(storage, db, table):
+        columns = [x.split('(')[0].lower() for x in columns]
+        existing = [[x.lower() for x in index] for index in storage.index_columns(cur, index_table)]
+        if not any(index[:len(columns)] == columns for index in existing):
+            missing.append("{} ({})".format(index_table, ', '.join(columns)))
+
+    if missing:
+        msg = ("Missing indexes on {} - re-run the importer with --incremental to create them"
+               .format('; '.join(missing)))
+        if storage.require_indexes:
+            raise MissingIndexes(msg)
+        print("WARNING: {}".format(msg))
+
+
+def add_storage_arguments(parser, reader=False):
+    """
+    Add the arguments for choosing a storage backend to an argparse parser.
+    Set reader for scripts that only read the {table}_ed_* tables.
+    """
+    parser.add_argument('-u', '--mysql-user', help='User to connect to mysql with')
+    parser.add_argument('-p', '--mysql-password', help='Password to connect to mysql with')
+    parser.add_argument('-s', '--mysql-host', help='Host to connect to')
+    parser.add_argument('-d', '--mysql-db', help='Database to connect to')
+    parser.add_argument('--sqlite', metavar='FILE',
+                        help='Use this SQLite file instead of mysql (see munster_to_sqlite.py)')
+    if reader:
+        parser.add_argument('--require-indexes', default=False, action='store_true',
+                            help='Abort if the tables are missing the indexes this needs')
+
+
+def get_storage(parser, args):
+    """
+    Return the storage backend chosen by the arguments (see
+    add_storage_arguments)
+    """
+    require_indexes = getattr(args, 'require_indexes', False)
+    if args.sqlite:
+        return SQLiteStorage(args.sqlite, require_indexes)
+
+    for arg in ('mysql_user', 'mysql_password', 'mysql_host', 'mysql_db'):
+        if getattr(args, arg) is None:
+            parser.error("--{} is required (unless using --sqlite)".format(arg.replace('_', '-')))
+
+    return MySQLStorage(args.mysql_host, args.mysql_db, args.mysql_user, args.mysql_password,
+                        require_indexes)
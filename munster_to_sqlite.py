@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Copy a Muenster dataset (the source table and the {table}_ed_vus,
+{table}_ed_map and {table}_ed_state tables made by the importers) from
+mysql into a single SQLite file, for use with the --sqlite option of the
+other Muenster scripts.
+"""
+
+import decimal
+import sqlite3
+
+from munster_storage import SQLiteStorage, add_storage_arguments, get_storage, create_map_indexes
+
+BATCH_SIZE = 10000
+
+# SQLite can't store these natively
+sqlite3.register_adapter(decimal.Decimal, str)
+
+
+def copy_table(storage, src, dst, table, types=None):
+    """
+    Copy a table from src to dst (which must be SQLite), streaming the rows.
+    types optionally maps column names to SQLite column definitions.
+    """
+    types = types or {}
+    cur = storage.streaming_cursor(src)
+    cur.execute("SELECT * FROM {}".format(table))
+    columns = [i[0] for i in cur.description]
+    cols = ["{} {}".format(x, types.get(x, '')).strip() for x in columns]
+
+    dst_cur = dst.cursor()
+    dst_cur.execute("DROP TABLE IF EXISTS {}".format(table))
+    dst_cur.execute("CREATE TABLE {} ({})".format(table, ', '.join(cols)))
+    query = "INSERT INTO {} VALUES ({})".format(table, ', '.join(['%s'] * len(columns)))
+
+    n = 0
+    while True:
+        rows = cur.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        dst_cur.executemany(query, rows)
+        n += len(rows)
+    cur.close()
+    dst.commit()
+    print("Copied {} rows of {}".format(n, table))
+
+
+def copy(storage, table, filename, skip_source=False):
+    """
+    Copy the dataset for table from storage into the SQLite file filename
+    """
+    src = storage.connect()
+    dst = SQLiteStorage(filename).connect()
+
+    cur = src.cursor()
+    cur.execute("SHOW TABLES LIKE %s", ("{}_ed_state".format(table), ))
+    has_state = bool(cur.fetchall())
+
+    if not skip_source:
+        copy_table(storage, src, dst, table)
+    copy_table(storage, src, dst, "{}_ed_vus".format(table), {'id': 'INTEGER PRIMARY KEY'})
+    copy_table(storage, src, dst, "{}_ed_map".format(table))
+    if has_state:
+        copy_table(storage, src, dst, "{}_ed_state".format(table), {'witness': 'PRIMARY KEY'})
+
+    print("Creating indexes")
+    create_map_indexes(SQLiteStorage(filename), dst, table)
+    dst.execute("ANALYZE")
+    dst.close()
+    print("See {}".format(filename))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Copy a Muenster dataset from mysql into a SQLite file")
+    add_storage_arguments(parser)
+    parser.add_argument('-t', '--table', required=True, help='Table name to copy')
+    parser.add_argument('--skip-source', default=False, action='store_true',
+                        help="Don't copy the source table (it's only needed by the importers)")
+    parser.add_argument('output_file', help='SQLite filename to create')
+    args = parser.parse_args()
+
+    storage = get_storage(parser, args)
+    if storage.name != 'mysql':
+        parser.error("Copying needs a mysql source")
+
+    copy(storage, args.table, args.output_file, args.skip_source)
@@ -1,83 +1,215 @@
 # -*- coding: utf-8 -*-
-import sys
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
 import string
-import MySQLdb
+
+import numpy
+
+from munster_dialects import get_vus_dialect
+from munster_storage import add_storage_arguments, get_storage, check_map_indexes, map_checksum
 
 MISSING = "-"
 GAP = "?"
+MISSING_IDENTS = ('zw', 'zz')
+
+# Code for "no reading" in the matrices read by read_matrix
+GAP_CODE = 0
+BATCH_SIZE = 10000
 
-_possible_symbols = list(string.ascii_letters) + list(string.digits)
-_sym_map = {}
+# Columns of the arrays returned by read_vus
+VU_ID, BOOK, CHAPTER, VERSE = range(4)
 
+SHARD_BY = ('book', 'chapter', 'verse-range')
+DEFAULT_SHARD_VERSES = 10
 
-def get_symbol(x):
+SYMBOLS = string.ascii_letters + string.digits
+
+
+def witness_query(table, book_col=None, book=None, min_extant=None):
     """
-    Return an appropriate symbol to use for MyBayes, always returning the
-    same symbol for the same input.
+    Return (query, params) to select each witness in {table}_ed_map with the
+    number of variant units it's extant in, optionally counting only those
+    in one book and keeping only witnesses extant in more than min_extant.
     """
-    if x in _sym_map:
-        return _sym_map[x]
-    else:
-        sym = _possible_symbols.pop(0)
-        _sym_map[x] = sym
-        return sym
+    # Count distinct variant units, as a witness can have several rows for
+    # one (e.g. for its correctors)
+    extant = "COUNT(DISTINCT CASE WHEN m.ident IN (%s, %s) THEN NULL ELSE m.vu_id END)"
+    query = "SELECT m.witness, {} FROM {}_ed_map m".format(extant, table)
+    params = list(MISSING_IDENTS)
+    if book:
+        query += " INNER JOIN {0}_ed_vus v ON v.id = m.vu_id WHERE v.{1} = %s".format(table, book_col)
+        params.append(book)
+    query += " GROUP BY m.witness"
+    if min_extant is not None:
+        query += " HAVING {} > %s".format(extant)
+        params.extend(MISSING_IDENTS)
+        params.append(min_extant)
+    return query, params
 
 
-def nexus(host, db, user, password, table, book, perc, filename):
+def read_matrix(storage, db, table, vus, witnesses, book_col=None, book=None, min_extant=None):
     """
-    Connect to the mysql db and loop through what we find
+    Read {table}_ed_map with a single streaming query, returning a uint8
+    matrix (witnesses x vus) of ident codes and the list of idents, where
+    code n means idents[n - 1] and GAP_CODE means no reading.
+
+    The book and min_extant filters (see witness_query) are applied by the
+    db, so only the readings needed are fetched.
     """
-    db = MySQLdb.connect(host=host, user=user, passwd=password, db=db, charset='utf8')
-    cur = db.cursor()
+    matrix = numpy.full((len(witnesses), len(vus)), GAP_CODE, dtype=numpy.uint8)
+    rows = {wit: i for i, wit in enumerate(witnesses)}
+    columns = {vu: i for i, vu in enumerate(vus)}
+    codes = {}
+    idents = []
 
+    query = "SELECT m.witness, m.vu_id, m.ident FROM {0}_ed_map m".format(table)
+    params = []
+    if min_extant is not None:
+        extant_query, params = witness_query(table, book_col, book, min_extant)
+        query += " INNER JOIN ({}) w ON w.witness = m.witness".format(extant_query)
     if book:
-        cur.execute("SELECT id FROM {}_ed_vus WHERE BOOK=%s ORDER BY id".format(table), (book, ))
-    else:
-        cur.execute("SELECT id FROM {}_ed_vus ORDER BY id".format(table))
-    vus = sorted([x[0] for x in cur.fetchall()])
-    target = len(vus) * perc / 100.0
-    print("Including only witnesses extant in {} ({}%) variant units".format(target, perc))
+        query += " INNER JOIN {0}_ed_vus v ON v.id = m.vu_id WHERE v.{1} = %s".format(table, book_col)
+        params.append(book)
+    query += " ORDER BY m.witness, m.vu_id"
 
-    cur.execute("SELECT DISTINCT(witness) FROM {}_ed_map".format(table))
-    witnesses = [x[0] for x in cur.fetchall()]
+    cur = storage.streaming_cursor(db)
+    cur.execute(query, params)
+    while True:
+        batch = cur.fetchmany(BATCH_SIZE)
+        if not batch:
+            break
+        for wit, vu_id, ident in batch:
+            col = columns.get(vu_id)
+            if col is None:
+                continue
+            code = codes.get(ident)
+            if code is None:
+                if len(idents) == 255 - GAP_CODE:
+                    raise ValueError("Too many different idents in {}_ed_map".format(table))
+                idents.append(ident)
+                code = codes[ident] = len(idents)
+            matrix[rows[wit], col] = code
+    cur.close()
+    return matrix, idents
 
-    symbols = set()
-    matrix = []
-    print()
-    witnesses_copy = witnesses[:]
-    for i, wit in enumerate(witnesses_copy):
-        sys.stdout.write("\r{}/{}: {}    ".format(i + 1, len(witnesses_copy), wit))
-        sys.stdout.flush()
-
-        cur.execute("SELECT vu_id, ident FROM {}_ed_map WHERE witness = %s".format(table),
-                    (wit, ))
-        wit_map = {}
-        for row in cur.fetchall():
-            ident = row[1]
-            # zw: the textual evidence does not allow to cite the witness for
-            # only one of the variants (equivalent of the double arrow in the
-            # ECM apparatus).
-            # zz: lacuna
-            if ident in ('zw', 'zz'):
-                label = MISSING
-            else:
-                label = get_symbol(ident)
-                symbols.add(label)
-
-            wit_map[row[0]] = label
-
-        stripe = []
-        for vu in vus:
-            stripe.append(wit_map.get(vu, GAP))
-
-        this_count = len([x for x in stripe if x not in (GAP, MISSING)])
-        if this_count > target:
-            matrix.append("{} {}".format(wit, ''.join(stripe)))
+
+def is_missing(ident):
+    """
+    Is the ident one that we treat as missing data?
+    """
+    # zw: the textual evidence does not allow to cite the witness for
+    # only one of the variants (equivalent of the double arrow in the
+    # ECM apparatus).
+    # zz: lacuna
+    return ident in MISSING_IDENTS
+
+
+def ident_symbols(idents):
+    """
+    Return the symbol to use for MrBayes for each ident, assigning SYMBOLS
+    in ident order, or None for those treated as missing. The same idents
+    always get the same symbols.
+    """
+    real = [x for x in idents if not is_missing(x)]
+    if len(real) > len(SYMBOLS):
+        raise ValueError("Too many different idents ({}) for one set of symbols - "
+                         "try --per-vu-symbols".format(len(real)))
+    symbols = dict(zip(real, SYMBOLS))
+    return [symbols.get(x) for x in idents]
+
+
+def global_symbols(idents):
+    """
+    Return a 256 entry table of the symbol byte for each ident code, using
+    the same symbol for an ident in every column (see ident_symbols), and
+    the symbols used.
+    """
+    labels = [GAP] + [MISSING if x is None else x for x in ident_symbols(idents)]
+    lut = numpy.zeros(256, dtype=numpy.uint8)
+    lut[:len(labels)] = [ord(x) for x in labels]
+    return lut, sorted(set(labels) - {GAP, MISSING})
+
+
+def per_vu_symbols(matrix, idents, vus):
+    """
+    Return a (ncols x 256) table of the symbol bytes for each ident code in
+    each column, numbering each column's idents from 'a' upwards in order of
+    frequency, the symbols used and {vu_id: {symbol: ident}}.
+    """
+    ncodes = len(idents) + 1
+    ncols = matrix.shape[1]
+
+    missing = [code + 1 for code, ident in enumerate(idents) if is_missing(ident)]
+    real = numpy.ones(ncodes, dtype=bool)
+    real[[GAP_CODE] + missing] = False
+
+    table = numpy.zeros((ncols, 256), dtype=numpy.uint8)
+    table[:, GAP_CODE] = ord(GAP)
+    table[:, missing] = ord(MISSING)
+    mapping = {}
+    width = 0
+    # Count a few MB of the matrix at a time
+    step = max(1, 2 ** 19 // max(1, matrix.shape[0]))
+    for start in range(0, ncols, step):
+        chunk = matrix[:, start:start + step]
+        # counts[col, code] - the number of witnesses with each code in each column
+        flat = chunk.astype(numpy.int64) + numpy.arange(chunk.shape[1]) * ncodes
+        counts = numpy.bincount(flat.ravel(), minlength=chunk.shape[1] * ncodes).reshape(-1, ncodes)
+        for i, vu in enumerate(vus[start:start + step]):
+            col = start + i
+            # Most frequent first, ties in ident order
+            present = [code for code in numpy.nonzero((counts[i] > 0) & real)[0]]
+            present.sort(key=lambda code: (-counts[i, code], str(idents[code - 1])))
+            if len(present) > len(SYMBOLS):
+                raise ValueError("Variant unit {} has too many readings ({})".format(vu, len(present)))
+            width = max(width, len(present))
+            mapping[vu] = {}
+            for j, code in enumerate(present):
+                sym = SYMBOLS[j]
+                table[col, code] = ord(sym)
+                mapping[vu][sym] = idents[code - 1]
+    return table, list(SYMBOLS[:width]), mapping
+
+
+def write_nexus(filename, witnesses, vus, matrix, idents, perc, symbols=None):
+    """
+    Write the witnesses (rows of matrix) extant in more than perc% of the
+    variant units (columns) to a NEXUS file. symbols is (lut, symbols) from
+    global_symbols, or None to give each character its own symbols
+    (see per_vu_symbols), recorded in a JSON file alongside the output.
+
+    Returns (filename, number of witnesses, number of variant units).
+    """
+    target = len(vus) * perc / 100.0
+    print("{}: including only witnesses extant in {} ({}%) variant units".format(filename, target, perc))
+
+    extant = numpy.ones(256, dtype=bool)
+    extant[GAP_CODE] = False
+    extant[[code + 1 for code, ident in enumerate(idents) if is_missing(ident)]] = False
+    counts = extant[matrix].sum(axis=1)
+    keep = []
+    for i, wit in enumerate(witnesses):
+        if counts[i] > target:
+            keep.append(i)
         else:
-            print("Deleting witness {} - it is only extant in {} variant unit(s)".format(wit, this_count))
-            del witnesses[witnesses.index(wit)]
+            print("Deleting witness {} - it is only extant in {} variant unit(s)".format(wit, counts[i]))
+
+    if symbols is None:
+        sym_table, symbols, mapping = per_vu_symbols(matrix[keep], idents, vus)
+        sidecar = "{}.symbols.json".format(filename)
+        with open(sidecar, 'w') as fh:
+            json.dump({str(vu): mapping[vu] for vu in vus}, fh, indent=1)
+        print("Symbols for each variant unit saved to {}".format(sidecar))
+    else:
+        lut, symbols = symbols
+        sym_table = None
+    columns = numpy.arange(len(vus))
 
-    nexus_data = """#nexus
+    with open(filename, 'w') as fh:
+        fh.write("""#nexus
 BEGIN Taxa;
 DIMENSIONS ntax={};
 TAXLABELS
@@ -94,42 +226,223 @@ FORMAT
     symbols="{}"
 ;
 MATRIX
-{}
-;
-END;
-""".format(len(witnesses),
-           "\n".join(witnesses),
+""".format(len(keep),
+           "\n".join(witnesses[i] for i in keep),
            len(vus),
            MISSING,
            GAP,
-           ' '.join(sorted(list(symbols))),
-           '\n'.join(matrix))
+           ' '.join(symbols)))
 
-    with open(filename, 'w') as fh:
-        fh.write(nexus_data)
+        for i in keep:
+            row = lut[matrix[i]] if sym_table is None else sym_table[columns, matrix[i]]
+            fh.write("{} {}\n".format(witnesses[i], row.tobytes().decode('ascii')))
+        fh.write(""";
+END;
+""")
+    return filename, len(keep), len(vus)
+
+
+def _write_shard(args):
+    return write_nexus(*args)
+
+
+def read_vus(db, table, book_col=None, book=None):
+    """
+    Return an int array of the variant units in {table}_ed_vus (optionally
+    only those in one book), ordered by id, with a row of VU_ID, BOOK,
+    CHAPTER and VERSE (where each starts, or -1 if not known) for each.
+    """
+    dialect = get_vus_dialect(db, table)
+    cols = [dialect[x] or 'NULL' for x in ('BOOK', 'CHBEG', 'VBEG')]
+    cur = db.cursor()
+    query = "SELECT id, {} FROM {}_ed_vus".format(', '.join(cols), table)
+    if book:
+        cur.execute(query + " WHERE {}=%s ORDER BY id".format(book_col), (book, ))
+    else:
+        cur.execute(query + " ORDER BY id")
+    rows = [[-1 if x is None else x for x in row] for row in cur.fetchall()]
+    return numpy.array(rows, dtype=numpy.int64).reshape(len(rows), 4)
+
+
+def shard_vus(vus, shard_by, verses=DEFAULT_SHARD_VERSES):
+    """
+    Split the variant units (from read_vus) into shards by book, chapter or
+    verse-range (of the given number of verses), according to where each
+    one starts. Returns {suffix: [index into vus]}, where suffix is like
+    b4_ch18_v1-10.
+    """
+    shards = {}
+    for i, (vu, book, chapter, verse) in enumerate(vus.tolist()):
+        parts = []
+        if book >= 0:
+            parts.append("b{}".format(book))
+        if shard_by in ('chapter', 'verse-range') and chapter >= 0:
+            parts.append("ch{}".format(chapter))
+        if shard_by == 'verse-range' and verse >= 0:
+            first = (verse - 1) // verses * verses + 1
+            parts.append("v{}-{}".format(first, first + verses - 1))
+        shards.setdefault('_'.join(parts) or 'all', []).append(i)
+    return shards
+
+
+def snapshot_dir(storage, db, table, cache_dir):
+    """
+    Return the directory for a snapshot of the table's current data
+    """
+    key = "{}|{}|{}".format(storage, table, map_checksum(storage, db, table))
+    return os.path.join(cache_dir, "{}_{}".format(table, hashlib.sha1(key.encode('utf8')).hexdigest()[:16]))
+
+
+def save_snapshot(path, witnesses, vus, matrix, idents):
+    """
+    Save the data from read_vus and read_matrix as a snapshot, for
+    load_snapshot.
+    """
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    os.makedirs(tmp)
+    out = numpy.lib.format.open_memmap(os.path.join(tmp, 'matrix.npy'), mode='w+',
+                                       dtype=numpy.uint8, shape=matrix.shape)
+    out[:] = matrix
+    out.flush()
+    del out
+    numpy.save(os.path.join(tmp, 'vus.npy'), vus)
+    with open(os.path.join(tmp, 'index.json'), 'w') as fh:
+        json.dump({'witnesses': witnesses,
+                   'idents': idents}, fh)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # Someone else saved it first
+        shutil.rmtree(tmp)
+
+
+def load_snapshot(path):
+    """
+    Load a snapshot saved by save_snapshot, returning (witnesses, vus,
+    matrix, idents) with the matrix memory mapped.
+    """
+    with open(os.path.join(path, 'index.json')) as fh:
+        index = json.load(fh)
+    return (index['witnesses'],
+            numpy.load(os.path.join(path, 'vus.npy')),
+            numpy.load(os.path.join(path, 'matrix.npy'), mmap_mode='r'),
+            index['idents'])
+
+
+def nexus(storage, table, book, perc, filename, per_vu=False, shard_by=None,
+          verses=DEFAULT_SHARD_VERSES, workers=None, cache_dir=None):
+    """
+    Connect to the db and loop through what we find
+
+    If per_vu is True then each character gets its own symbols (see
+    per_vu_symbols), recorded in a JSON file alongside the output.
+
+    If shard_by is set (see shard_vus) then a NEXUS file is written for each
+    shard, named after filename, by a pool of worker processes. The extant
+    percentage applies to each shard separately.
+
+    If cache_dir is set then the whole table is read into a snapshot there
+    (see save_snapshot), which later runs use instead of the db for as long
+    as the table's data is unchanged (see map_checksum).
+    """
+    db = storage.connect()
+    cur = db.cursor()
+
+    book_col = None
+    if book:
+        book_col = get_vus_dialect(db, table)['BOOK']
+        if book_col is None:
+            raise ValueError("{}_ed_vus has no book column".format(table))
+
+    snapshot = snapshot_dir(storage, db, table, cache_dir) if cache_dir else None
+    if snapshot and os.path.exists(snapshot):
+        print("Using snapshot {}".format(snapshot))
+        witnesses, vus, matrix, idents = load_snapshot(snapshot)
+    else:
+        check_map_indexes(storage, db, table)
+        # Snapshots have every book, so they can be reused for any of them
+        read_book = None if snapshot else book
+        vus = read_vus(db, table, book_col, read_book)
+        # Leave out the witnesses that aren't extant enough in the db, unless
+        # we're saving a snapshot or the percentage applies to each shard
+        min_extant = None
+        if perc and not snapshot and not shard_by:
+            min_extant = len(vus) * perc / 100.0
+        query, params = witness_query(table, book_col, read_book, min_extant)
+        cur.execute(query + " ORDER BY m.witness", params)
+        witnesses = [x[0] for x in cur.fetchall()]
+        if min_extant is not None:
+            print("{} witnesses are extant in more than {} variant units".format(len(witnesses), min_extant))
+        matrix, idents = read_matrix(storage, db, table, vus[:, VU_ID].tolist(), witnesses,
+                                     book_col, read_book, min_extant)
+        if snapshot:
+            print("Saving snapshot {}".format(snapshot))
+            save_snapshot(snapshot, witnesses, vus, matrix, idents)
+
+    if book and snapshot:
+        cols = numpy.nonzero(vus[:, BOOK] == book)[0]
+        vus = vus[cols]
+        matrix = matrix[:, cols]
+
+    symbols = None
+    if not per_vu:
+        symbols = global_symbols(idents)
+
+    vu_ids = vus[:, VU_ID].tolist()
+    if not shard_by:
+        write_nexus(filename, witnesses, vu_ids, matrix, idents, perc, symbols)
+        return
+
+    base, ext = os.path.splitext(filename)
+    jobs = []
+    for suffix, cols in shard_vus(vus, shard_by, verses).items():
+        jobs.append(("{}_{}{}".format(base, suffix, ext), witnesses, [vu_ids[i] for i in cols],
+                     matrix[:, cols], idents, perc,
+                     symbols))
+    print("Writing {} shards".format(len(jobs)))
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for shard, ntax, nchar in pool.imap(_write_shard, jobs):
+            print("{}: {} witnesses, {} variant units".format(shard, ntax, nchar))
+    finally:
+        pool.close()
+        pool.join()
 
 
 def main():
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('-u', '--mysql-user', required=True, help='User to connect to mysql with')
-    parser.add_argument('-p', '--mysql-password', required=True, help='Password to connect to mysql with')
-    parser.add_argument('-s', '--mysql-host', required=True, help='Host to connect to')
-    parser.add_argument('-d', '--mysql-db', required=True, help='Database to connect to')
+    add_storage_arguments(parser, reader=True)
     parser.add_argument('-t', '--table', required=True, help='Table name to get data from')
     parser.add_argument('-b', '--book', default=0, type=int, help='Restrict to the specified book number')
     parser.add_argument('-e', '--extant_perc', default=0, type=int, help='Percentage of variant units a witness must attest to be included')
+    parser.add_argument('--per-vu-symbols', default=False, action='store_true',
+                        help='Number the readings of each variant unit from "a" by frequency, '
+                             'saving the mapping back to idents in OUTPUT_FILE.symbols.json')
+    parser.add_argument('--shard-by', choices=SHARD_BY,
+                        help='Write a separate nexus file for each book, chapter or range of verses, '
+                             'named like OUTPUT_FILE_b4_ch18.nex')
+    parser.add_argument('--shard-verses', default=DEFAULT_SHARD_VERSES, type=int,
+                        help='Number of verses in each verse-range shard (default {})'.format(DEFAULT_SHARD_VERSES))
+    parser.add_argument('--workers', default=None, type=int,
+                        help='Number of processes writing shards (default: one per cpu)')
+    parser.add_argument('--cache-dir',
+                        help='Keep a snapshot of the table here, and use it rather than the db '
+                             'until the table changes')
     parser.add_argument('output_file', help='Filename to save nexus data to')
     args = parser.parse_args()
 
-    nexus(args.mysql_host,
-          args.mysql_db,
-          args.mysql_user,
-          args.mysql_password,
+    nexus(get_storage(parser, args),
           args.table,
           args.book,
           args.extant_perc,
-          args.output_file)
+          args.output_file,
+          args.per_vu_symbols,
+          args.shard_by,
+          args.shard_verses,
+          args.workers,
+          args.cache_dir)
     print()
 
 if __name__ == "__main__":
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+A reader for the character matrices of NEXUS files, shared by the scripts
+here. It understands TAXA, CHARACTERS and DATA blocks (skipping any
+others), keywords in any case, comments, quoted taxon names, and matrices
+that are interleaved or wrap over several lines.
+
+The file is memory mapped, and the matrix is read into a numpy array of
+bytes, so big files don't need their text held in memory as well.
+"""
+
+import mmap
+import re
+
+import numpy
+
+# A token: a quoted string, punctuation, or a run of anything else. Comments
+# and whitespace before it are skipped.
+_token = re.compile(rb"""(?:\s|\[[^\]]*\])*
+                         ('(?:[^']|'')*'|"[^"]*"|[;=]|[^\s;=\[\]'"]+)""", re.VERBOSE)
+_comment = re.compile(rb"\[[^\]]*\]")
+
+
+class NexusError(ValueError):
+    pass
+
+
+class NexusMatrix(object):
+    """
+    The taxa and character matrix of a NEXUS file. matrix is a uint8 array
+    (ntax x nchar) of the character symbols' ascii codes, or None if only the
+    header was read.
+    """
+    def __init__(self, taxa, matrix, symbols=None, missing='?', gap='-', datatype='standard',
+                 nchar=None):
+        self.taxa = taxa
+        self.matrix = matrix
+        self.nchar = matrix.shape[1] if matrix is not None else nchar
+        self.symbols = symbols or []
+        self.missing = missing
+        self.gap = gap
+        self.datatype = datatype
+        self.index = {t: i for i, t in enumerate(taxa)}
+
+    @property
+    def ntax(self):
+        return len(self.taxa)
+
+    def row(self, taxon):
+        """
+        Return the characters of a taxon as a string
+        """
+        return self.matrix[self.index[taxon]].tobytes().decode('ascii')
+
+    def rows(self):
+        """
+        Iterate over (taxon, characters string) in matrix order
+        """
+        for i, taxon in enumerate(self.taxa):
+            yield taxon, self.matrix[i].tobytes().decode('ascii')
+
+
+class _Tokenizer(object):
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+
+    def next(self):
+        """
+        Return the next token (as a str, with any quotes removed), or None at
+        the end of the file
+        """
+        match = _token.match(self.data, self.pos)
+        if not match:
+            return None
+        self.pos = match.end()
+        token = match.group(1).decode('utf8')
+        if token[0] == "'":
+            return token[1:-1].replace("''", "'")
+        if token[0] == '"':
+            return token[1:-1]
+        return token
+
+    def command(self):
+        """
+        Return the tokens of the next command (up to its ';'), with the
+        first upper-cased, or None at the end of the file. For MATRIX only
+        the keyword is read, leaving pos at the start of the rows.
+        """
+        first = self.next()
+        if first is None:
+            return None
+        tokens = [first.upper()]
+        if tokens[0] == 'MATRIX':
+            return tokens
+        tokens.append(self.next())
+        while tokens[-1] != ';':
+            if tokens[-1] is None:
+                raise NexusError("Unexpected end of file in {}".format(tokens[0]))
+            tokens.append(self.next())
+        return tokens[:-1]
+
+
+def _options(tokens):
+    """
+    Return the key=value (and bare key) options of a command as a dict with
+    lower case keys
+    """
+    opts = {}
+    i = 0
+    while i < len(tokens):
+        key = tokens[i].lower()
+        if i + 2 < len(tokens) and tokens[i + 1] == '=':
+            opts[key] = tokens[i + 2]
+            i += 3
+        else:
+            opts[key] = True
+            i += 1
+    return opts
+
+
+def _split_name(line):
+    """
+    Split a matrix line into (taxon name, rest)
+    """
+    if line.startswith(b"'"):
+        end = 1
+        while True:
+            end = line.index(b"'", end)
+            if line[end + 1:end + 2] != b"'":
+                break
+            end += 2
+        return line[1:end].replace(b"''", b"'").decode('utf8'), line[end + 1:]
+    parts = line.split(None, 1)
+    return parts[0].decode('utf8'), parts[1] if len(parts) > 1 else b''
+
+
+def _read_matrix(data, pos, taxa, ntax, nchar, missing, interleave):
+    """
+    Read the rows of a MATRIX command starting at pos. Returns (taxa,
+    matrix, position after the closing ';').
+    """
+    end = data.find(b';', pos)
+    if end < 0:
+        raise NexusError("Unterminated MATRIX")
+
+    matrix = numpy.full((ntax, nchar), ord(missing), dtype=numpy.uint8)
+    filled = [0] * ntax
+    index = {t: i for i, t in enumerate(taxa)}
+    taxa = list(taxa)
+    current = None
+
+    while pos < end:
+        eol = data.find(b'\n', pos, end)
+        if eol < 0:
+            eol = end
+        line = data[pos:eol].strip()
+        pos = eol + 1
+        if b'[' in line:
+            line = _comment.sub(b'', line).strip()
+        if not line:
+            continue
+
+        if not interleave and current is not None and filled[current] < nchar:
+            # A continuation of the last taxon's row
+            chars = line
+        else:
+            name, chars = _split_name(line)
+            if name not in index:
+                if len(taxa) == ntax:
+                    raise NexusError("Too many taxa in MATRIX ({} isn't in the {} expected)".format(name, ntax))
+                index[name] = len(taxa)
+                taxa.append(name)
+            current = index[name]
+
+        chars = b''.join(chars.split())
+        start = filled[current]
+        if start + len(chars) > nchar:
+            raise NexusError("Taxon {} has more than {} characters".format(taxa[current], nchar))
+        matrix[current, start:start + len(chars)] = numpy.frombuffer(chars, dtype=numpy.uint8)
+        filled[current] += len(chars)
+
+    if len(taxa) != ntax:
+        raise NexusError("Found {} taxa in MATRIX, expected {}".format(len(taxa), ntax))
+    short = [taxa[i] for i in range(ntax) if filled[i] != nchar]
+    if short:
+        raise NexusError("Taxa with fewer than {} characters: {}".format(nchar, ', '.join(short)))
+    return taxa, matrix, end + 1
+
+
+def read_nexus(filename, header_only=False):
+    """
+    Read the character matrix of a NEXUS file, returning a NexusMatrix. If
+    header_only is True then (as long as the file has a TAXLABELS command)
+    reading stops at the matrix, and the NexusMatrix has just the taxa,
+    dimensions and format.
+    """
+    with open(filename, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return _parse(data, header_only)
+    finally:
+        data.close()
+
+
+def _parse(data, header_only=False):
+    tok = _Tokenizer(data)
+    first = tok.next()
+    if first is None or first.upper() != '#NEXUS':
+        raise NexusError("Not a NEXUS file")
+
+    taxa = []
+    ntax = None
+    result = None
+    block = None
+    fmt = {}
+    nchar = None
+
+    while True:
+        cmd = tok.command()
+        if cmd is None:
+            break
+        name, args = cmd[0], cmd[1:]
+
+        if name == 'BEGIN':
+            block = args[0].upper() if args else None
+            fmt = {}
+        elif name in ('END', 'ENDBLOCK'):
+            block = None
+        elif block not in ('TAXA', 'CHARACTERS', 'DATA'):
+            continue
+        elif name == 'DIMENSIONS':
+            opts = _options(args)
+            if 'ntax' in opts:
+                ntax = int(opts['ntax'])
+            if 'nchar' in opts:
+                nchar = int(opts['nchar'])
+        elif name == 'TAXLABELS':
+            taxa = args
+        elif name == 'FORMAT':
+            fmt = _options(args)
+        elif name == 'MATRIX':
+            if nchar is None:
+                raise NexusError("No NCHAR before MATRIX")
+            if ntax is None:
+                ntax = len(taxa)
+            missing = fmt.get('missing', '?')
+            symbols = fmt.get('symbols', '')
+            header = dict(symbols=[x for x in symbols if not x.isspace()] if symbols is not True else [],
+                          missing=missing,
+                          gap=fmt.get('gap', '-'),
+                          datatype=str(fmt.get('datatype', 'standard')).lower())
+            if header_only and len(taxa) == ntax:
+                return NexusMatrix(list(taxa), None, nchar=nchar, **header)
+
+            interleave = fmt.get('interleave', False)
+            if isinstance(interleave, str):
+                interleave = interleave.lower() != 'no'
+            matrix_taxa, matrix, tok.pos = _read_matrix(data, tok.pos, taxa, ntax, nchar,
+                                                        missing, interleave)
+            result = NexusMatrix(matrix_taxa, matrix, **header)
+            matchchar = fmt.get('matchchar')
+            if isinstance(matchchar, str) and result.ntax:
+                match = result.matrix == ord(matchchar)
+                result.matrix[match] = numpy.broadcast_to(result.matrix[0], result.matrix.shape)[match]
+
+    if result is None:
+        raise NexusError("No MATRIX found")
+    return result
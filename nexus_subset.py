@@ -1,8 +1,170 @@
+import json
+import multiprocessing
+
+import numpy
+
+from nexus_reader import read_nexus
+
 DNA = 'ACTG'
 PROTIEN = 'FSTKEYVQMCLAWPHDRIG'  # Amino acids... NOTE: We miss out 'N' because Network.exe gets confused by it...
+GAP_MISSING = '-?'
+ENCODINGS = {'standard': None, 'dna': DNA, 'amino-acid': PROTIEN}
+MANIFEST_KEYS = ('output', 'taxa', 'fragmentation', 'encoding', 'ignore_too_many_character_states',
+                 'informative_only', 'compress_patterns', 'wtset')
+
+
+def column_states(matrix):
+    """
+    Count the states in each column of a (taxa x characters) byte matrix.
+    Returns (values, counts), where values is an array of the byte values
+    found in the matrix and counts[i, j] is the number of taxa with
+    values[j] in column i.
+    """
+    values = numpy.nonzero(numpy.bincount(matrix.ravel(), minlength=256))[0]
+    counts = numpy.zeros((matrix.shape[1], len(values)), dtype=numpy.int64)
+    for j, v in enumerate(values):
+        counts[:, j] = (matrix == v).sum(axis=0)
+    return values, counts
+
+
+def recode_tables(values, counts, trans=None):
+    """
+    Return (tables, n_states) for the columns described by column_states,
+    where tables[i, j] is the byte to write for values[j] in column i and
+    n_states[i] is the number of states (other than gap and missing) in
+    column i. With trans, each column's states are recoded to the symbols
+    of trans in order (leaving gap and missing alone) - columns with more
+    states than that have tables of zeros.
+    """
+    real = ~numpy.isin(values, [ord(x) for x in GAP_MISSING])
+    present = (counts > 0) & real
+    n_states = present.sum(axis=1)
+
+    tables = numpy.tile(values.astype(numpy.uint8), (counts.shape[0], 1))
+    if trans:
+        symbols = numpy.frombuffer(trans.encode('ascii'), dtype=numpy.uint8)
+        rank = numpy.cumsum(present, axis=1) - 1
+        ok = (n_states <= len(trans))[:, None] & present
+        tables[ok] = symbols[rank[ok]]
+        tables[n_states > len(trans)] = 0
+    return tables, n_states
+
+
+def informative(values, counts):
+    """
+    Return a boolean array saying which of the columns described by
+    column_states are parsimony informative - that is, have at least two
+    states (other than gap and missing) that are each found in at least two
+    taxa.
+    """
+    real = ~numpy.isin(values, [ord(x) for x in GAP_MISSING])
+    return ((counts[:, real] >= 2).sum(axis=1) >= 2)
+
+
+def _slots(values):
+    """
+    Return an array giving the index into values (and so the columns of
+    tables) for each byte
+    """
+    slot = numpy.zeros(256, dtype=numpy.int64)
+    slot[values] = numpy.arange(len(values))
+    return slot
+
+
+def compress_patterns(matrix, columns, values, tables):
+    """
+    Collapse the given columns of matrix that are identical once translated
+    into single site patterns. Returns (columns, weights, pattern), where
+    columns has the first column of each pattern (in their original order),
+    weights the number of columns with that pattern, and pattern the index
+    into those for each of the given columns.
+    """
+    if not len(columns):
+        return columns, numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+    translated = tables[columns[None, :], _slots(values)[matrix[:, columns]]]
+    _, first, inverse, weights = numpy.unique(translated.T, axis=0, return_index=True,
+                                              return_inverse=True, return_counts=True)
+    order = numpy.argsort(first)
+    rank = numpy.empty_like(order)
+    rank[order] = numpy.arange(len(order))
+    return columns[first[order]], weights[order], rank[inverse.ravel()]
+
+
+def _ranges(numbers):
+    """
+    Return a sorted list of numbers as a NEXUS character list - e.g. "1-3 5"
+    """
+    parts = []
+    start = prev = None
+    for n in numbers:
+        if prev is not None and n == prev + 1:
+            prev = n
+            continue
+        if start is not None:
+            parts.append(str(start) if start == prev else "{}-{}".format(start, prev))
+        start = prev = n
+    if start is not None:
+        parts.append(str(start) if start == prev else "{}-{}".format(start, prev))
+    return ' '.join(parts)
+
+
+def weights_block(weights):
+    """
+    Return an ASSUMPTIONS block with a WTSET giving the weight of each
+    character (numbered from 1), as read by PAUP. MrBayes and Network don't
+    read it.
+    """
+    by_weight = {}
+    for i, w in enumerate(weights.tolist()):
+        by_weight.setdefault(w, []).append(i + 1)
+    return "begin assumptions;\nwtset * patterns = {};\nend;\n".format(
+        ', '.join("{}: {}".format(w, _ranges(chars)) for w, chars in sorted(by_weight.items())))
+
+
+def write_weights(filename, columns, weights, pattern, all_columns):
+    """
+    Write a csv of the weight of each site pattern in a compressed subset,
+    and the input characters (numbered from 1) it stands for
+    """
+    chars = [[] for _ in range(len(columns))]
+    for c, p in zip(all_columns.tolist(), pattern.tolist()):
+        chars[p].append(c + 1)
+    with open(filename, 'w') as fh:
+        fh.write("pattern,weight,characters\n")
+        for i, w in enumerate(weights.tolist()):
+            fh.write("{},{},{}\n".format(i + 1, w, ' '.join(str(x) for x in chars[i])))
+
+
+def write_subset(output_file, names, matrix, columns, values, tables, trans_name, weights=None):
+    """
+    Write the given columns of matrix (one row per name) to a nexus file,
+    translating each character with the tables from recode_tables. Each row
+    is translated with array indexing and written in one go. If weights are
+    given then they're written in an ASSUMPTIONS block after the matrix.
+    """
+    slot = _slots(values)
+    tables = tables[columns]
+    col_index = numpy.arange(len(columns))
+
+    with open(output_file, 'w') as output:
+        # header
+        output.write("""#NEXUS
+begin data;
+dimensions ntax={} nchar={};
+format missing=? gap=- matchchar=. datatype={};
+matrix
+""".format(len(names), len(columns), trans_name))
+        for r, k in enumerate(names):
+            row = tables[col_index, slot[matrix[r, columns]]]
+            output.write("{} {}\n".format(k, row.tobytes().decode('ascii')))
+
+        output.write(";\nEND;\n")
+        if weights is not None and len(weights):
+            output.write(weights_block(weights))
 
 
-def subset(input_file, output_file, taxa, trans, frag_perc, skip_complex_characters=False):
+def subset(input_file, output_file, taxa, trans, frag_perc, skip_complex_characters=False,
+           informative_only=False, compress=False, wtset=False):
     """
     Create a subset of the supplied nexus file using only the listed taxa.
 
@@ -12,79 +174,85 @@ def subset(input_file, output_file, taxa, trans, frag_perc, skip_complex_charact
     @param trans: characters to transform into
     @param frag_perc: (int) fragmentation percentage above which witnesses are excluded
     @param skip_complex_characters: (bool) skip characters with too many states for the chosen encoding
+    @param informative_only: (bool) remove characters that aren't parsimony informative
+    @param compress: (bool) collapse identical characters into one site pattern, writing the
+                     weight of each pattern to OUTPUT.weights.csv
+    @param wtset: (bool) also write the weights of compressed patterns in an ASSUMPTIONS block
 
     Constant characters are removed.
     """
-    with open(input_file) as f:
-        data = f.read()
+    nex = read_nexus(input_file)
+    return subset_matrix(nex, output_file, taxa, trans, frag_perc, skip_complex_characters,
+                         informative_only, compress, wtset)
+
 
+def subset_matrix(nex, output_file, taxa, trans, frag_perc, skip_complex_characters=False,
+                  informative_only=False, compress=False, wtset=False):
+    """
+    As subset, but for a NexusMatrix that has already been read. Returns
+    (number of taxa, number of characters) written.
+    """
     auto_taxa = False
     if taxa == ['all']:
         print("Using all taxa found in input file")
         auto_taxa = True
         taxa = []
 
-    in_m = False
-    stripes = {}
-    for line in data.splitlines():
-        if in_m and ' ' in line:
-            n, chars = line.split()
-            total_chars = len(chars)
-            missing_chars = chars.count('?') + chars.count('-')
-            my_frag_perc = (missing_chars * 100.0 / total_chars)
-            if my_frag_perc > frag_perc:
-                print("{} is {} fragmented - excluding it"
-                      .format(n, my_frag_perc))
-                continue
-
-            if auto_taxa:
-                taxa.append(n)
-            elif n not in taxa:
-                continue
-
-            stripes[n] = chars
-
-        if line.strip().upper() == 'MATRIX':
-            in_m = True
-
-    assert stripes, stripes
-
-    keep = []
-    convs = {}
-    complex_chars = []
-    for i, a in enumerate(list(stripes.values())[0]):
-        col = set()
-        for k in stripes:
-            col.add(stripes[k][i])
-        if len(list(col)) != 1:
-            keep.append(i)
-
-        col_conv = {}
-
-        if trans:
-            # Transform
-            n_states = len([a for a in col if a not in ('-', '?')])
-            if n_states > len(trans):
-                if skip_complex_characters:
-                    print("Character {} has {} character states - skipping".format(i, n_states))
-                    complex_chars.append(i)
-                    continue
-                else:
-                    raise ValueError("More than {} character states ({}) - cannot do transform "
-                                     "(consider using --ignore-too-many-character-states)"
-                                     .format(len(trans), n_states))
-            use = list(tuple(trans))
-
-        for s in col:
-            if trans:
-                if s in ('-', '?'):
-                    col_conv[s] = s
-                else:
-                    col_conv[s] = use.pop(0)
+    missing_chars = numpy.zeros(nex.ntax, dtype=numpy.int64)
+    for x in GAP_MISSING:
+        missing_chars += (nex.matrix == ord(x)).sum(axis=1)
+    frag = missing_chars * 100.0 / nex.nchar
+
+    rows = []
+    for i, n in enumerate(nex.taxa):
+        if frag[i] > frag_perc:
+            print("{} is {} fragmented - excluding it"
+                  .format(n, frag[i]))
+            continue
+
+        if auto_taxa:
+            taxa.append(n)
+        elif n not in taxa:
+            continue
+
+        rows.append(i)
+
+    assert rows, rows
+    names = [nex.taxa[i] for i in rows]
+    matrix = nex.matrix[rows]
+
+    values, counts = column_states(matrix)
+    # Constant characters have only one state (counting gap and missing)
+    keep = (counts > 0).sum(axis=1) != 1
+    if informative_only:
+        useful = informative(values, counts)
+        print("Removing {} uninformative characters".format(int((keep & ~useful).sum())))
+        keep &= useful
+    tables, n_states = recode_tables(values, counts, trans)
+
+    complex_chars = set()
+    if trans:
+        for i in numpy.nonzero(keep & (n_states > len(trans)))[0].tolist():
+            if skip_complex_characters:
+                print("Character {} has {} character states - skipping".format(i, n_states[i]))
+                complex_chars.add(i)
             else:
-                col_conv[s] = s
+                raise ValueError("More than {} character states ({}) - cannot do transform "
+                                 "(consider using --ignore-too-many-character-states)"
+                                 .format(len(trans), n_states[i]))
+    columns = numpy.array([i for i in numpy.nonzero(keep)[0].tolist() if i not in complex_chars],
+                          dtype=numpy.int64)
 
-        convs[i] = col_conv
+    weights = None
+    if compress:
+        all_columns = columns
+        columns, weights, pattern = compress_patterns(matrix, columns, values, tables)
+        print("Compressed {} characters into {} site patterns".format(len(all_columns), len(columns)))
+        sidecar = "{}.weights.csv".format(output_file)
+        write_weights(sidecar, columns, weights, pattern, all_columns)
+        print("Pattern weights saved to {}".format(sidecar))
+        print("WARNING: {} has one character per site pattern - programs that don't apply the weights "
+              "(including MrBayes and Network) will give each pattern a weight of 1".format(output_file))
 
     if trans == DNA:
         trans_name = 'dna'
@@ -93,27 +261,101 @@ def subset(input_file, output_file, taxa, trans, frag_perc, skip_complex_charact
     else:
         trans_name = 'standard'
 
-    with open(output_file, 'w') as output:
-        # header
-        output.write("""#NEXUS
-begin data;
-dimensions ntax={} nchar={};
-format missing=? gap=- matchchar=. datatype={};
-matrix
-""".format(len(taxa), len(keep), trans_name))
-        for k in stripes:
-            output.write("{} ".format(k))
-            for i in keep:
-                if i not in complex_chars:
-                    assert i in convs
-                    output.write(convs[i][stripes[k][i]])
-            output.write('\n')
-
-        output.write(";\nEND;\n")
+    write_subset(output_file, names, matrix, columns, values, tables, trans_name,
+                 weights if wtset else None)
 
     if complex_chars:
         print("WARNING: Skipped {} characters as they were too complex for the encoding".format(len(complex_chars)))
-    print("File {} written".format(output))
+    print("File {} written".format(output_file))
+    return len(names), len(columns)
+
+
+def read_manifest(filename):
+    """
+    Read a manifest of subsets to make - a JSON or (if the filename ends in
+    .yaml or .yml, and PyYAML is installed) YAML list, with an entry like
+    this for each subset:
+
+        {"output": "subset.nex",        # required
+         "taxa": ["03", "1", "10"],     # default "all"
+         "fragmentation": 25,           # default 25
+         "encoding": "dna",             # dna, amino-acid or standard (the default)
+         "ignore_too_many_character_states": false,
+         "informative_only": false,
+         "compress_patterns": false,
+         "wtset": false}
+
+    Returns a list of (output_file, taxa, trans, frag_perc,
+    skip_complex_characters, informative_only, compress, wtset)
+    arguments for subset_matrix.
+    """
+    with open(filename) as fh:
+        if filename.lower().endswith(('.yaml', '.yml')):
+            import yaml
+            specs = yaml.safe_load(fh)
+        else:
+            specs = json.load(fh)
+
+    if not isinstance(specs, list):
+        raise ValueError("Manifest {} should be a list of subsets".format(filename))
+
+    jobs = []
+    for i, spec in enumerate(specs):
+        unknown = set(spec) - set(MANIFEST_KEYS)
+        if unknown:
+            raise ValueError("Unknown keys in subset {} of {}: {}".format(i, filename, ', '.join(sorted(unknown))))
+        if 'output' not in spec:
+            raise ValueError("No output for subset {} of {}".format(i, filename))
+        encoding = spec.get('encoding', 'standard')
+        if encoding not in ENCODINGS:
+            raise ValueError("Unknown encoding {} for subset {} of {} (should be one of {})"
+                             .format(encoding, i, filename, ', '.join(ENCODINGS)))
+        if spec.get('wtset') and not spec.get('compress_patterns'):
+            raise ValueError("wtset needs compress_patterns in subset {} of {}".format(i, filename))
+        taxa = spec.get('taxa', 'all')
+        if taxa != 'all' and not isinstance(taxa, list):
+            raise ValueError("Taxa for subset {} of {} should be a list or \"all\"".format(i, filename))
+        jobs.append((spec['output'],
+                     ['all'] if taxa == 'all' else [str(x) for x in taxa],
+                     ENCODINGS[encoding],
+                     spec.get('fragmentation', 25),
+                     bool(spec.get('ignore_too_many_character_states', False)),
+                     bool(spec.get('informative_only', False)),
+                     bool(spec.get('compress_patterns', False)),
+                     bool(spec.get('wtset', False))))
+    return jobs
+
+
+_manifest_nex = None
+
+
+def _init_manifest_worker(nex):
+    global _manifest_nex
+    _manifest_nex = nex
+
+
+def _manifest_subset(args):
+    return (args[0], ) + subset_matrix(_manifest_nex, *args)
+
+
+def run_manifest(input_file, manifest_file, workers=None):
+    """
+    Make all the subsets listed in a manifest (see read_manifest) from one
+    reading of the input file, writing them with a pool of worker
+    processes (default: one per cpu).
+    """
+    jobs = read_manifest(manifest_file)
+    nex = read_nexus(input_file)
+    print("Making {} subsets of {}".format(len(jobs), input_file))
+
+    pool = multiprocessing.Pool(workers, _init_manifest_worker, (nex, ))
+    try:
+        for output_file, ntax, nchar in pool.imap(_manifest_subset, jobs):
+            print("{}: {} taxa, {} characters".format(output_file, ntax, nchar))
+    finally:
+        pool.close()
+        pool.join()
+
 
 if __name__ == "__main__":
     import argparse
@@ -129,20 +371,46 @@ if __name__ == "__main__":
                         help='Input filename')
     parser.add_argument('-o', '--output-file',
                         help='Output filename')
-    parser.add_argument('taxon', nargs='+',
+    parser.add_argument('--informative-only', default=False, action='store_true',
+                        help="Remove characters that aren't parsimony informative (as well as constant ones) "
+                             "- note this changes the likelihood")
+    parser.add_argument('--compress-patterns', default=False, action='store_true',
+                        help='Collapse identical characters into one site pattern, writing the weight of each '
+                             '(and the characters it stands for) to OUTPUT_FILE.weights.csv. The analysis must '
+                             'apply the weights to get the same likelihood - MrBayes and Network can\'t.')
+    parser.add_argument('--wtset', default=False, action='store_true',
+                        help='With --compress-patterns, also write the weights as a WTSET in an ASSUMPTIONS '
+                             'block after the matrix, for PAUP')
+    parser.add_argument('-m', '--manifest',
+                        help='JSON (or YAML) list of subsets to make from the input file - '
+                             'see read_manifest for the format. Replaces the other options and the taxa.')
+    parser.add_argument('--workers', default=None, type=int,
+                        help='Number of processes writing manifest subsets (default: one per cpu)')
+    parser.add_argument('taxon', nargs='*',
                         help="Taxa to include (can be 'all')")
     parser.add_argument('--ignore-too-many-character-states', default=False, action='store_true',
                         help="For characters with too many states for the encoding, just ignore them. Default is to abort.")
     args = parser.parse_args()
 
-    transform = None
-    if args.dna_transform:
-        transform = DNA
-    elif args.amino_acid_transform:
-        transform = PROTIEN
+    if args.wtset and not args.compress_patterns:
+        parser.error("--wtset needs --compress-patterns")
+    if args.manifest:
+        if args.taxon or args.output_file:
+            parser.error("--manifest can't be used with an output file or taxa")
+        run_manifest(args.input_file, args.manifest, args.workers)
+    else:
+        if not args.taxon or not args.output_file:
+            parser.error("An output file and taxa are required (unless using --manifest)")
+
+        transform = None
+        if args.dna_transform:
+            transform = DNA
+        elif args.amino_acid_transform:
+            transform = PROTIEN
 
-    if not transform:
-        print("Not transforming symbols - see -a or -d for details")
+        if not transform:
+            print("Not transforming symbols - see -a or -d for details")
 
-    subset(args.input_file, args.output_file, args.taxon, transform, args.fragmentation_level,
-           args.ignore_too_many_character_states)
+        subset(args.input_file, args.output_file, args.taxon, transform, args.fragmentation_level,
+               args.ignore_too_many_character_states, args.informative_only, args.compress_patterns,
+               args.wtset)
@@ -7,40 +7,21 @@ from collections import OrderedDict
 import json
 import os
 
+from nexus_reader import read_nexus
+
 
 def convert(inputfile, ignore_missing):
     """
     Convert NEXUS to RDF and create a JSON mapping for use by relabel_fdi.py.
     """
-    with open(inputfile) as f:
-        data = f.readlines()
+    nex = read_nexus(inputfile)
 
     name = os.path.splitext(inputfile)[0]
 
-    matrix = OrderedDict()
-
-    in_matrix = False
-    is_dna = False
-    is_protien = False
-    for line in data:
-        if "datatype=dna" in line:
-            is_dna = True
-        elif "datatype=protien" in line:
-            is_protien = True
-
-        line = line.strip()
-        if line.lower() == 'matrix':
-            in_matrix = True
-            continue
-
-        if not in_matrix:
-            continue
-
-        if ' ' not in line:
-            continue
+    matrix = OrderedDict(nex.rows())
 
-        label, stripe = line.split()
-        matrix[label] = stripe
+    is_dna = nex.datatype == 'dna'
+    is_protien = nex.datatype == 'protien'
 
     if not is_dna and not is_protien:
         raise ValueError("Not DNA or protien file - help!")
@@ -50,7 +31,7 @@ def convert(inputfile, ignore_missing):
         ignore_missing = True
 
     # total input characters
-    n_chars = len(stripe)
+    n_chars = nex.nchar
 
     GAP = '-'
     MISSING = '?'